@@ -0,0 +1,91 @@
+# benchmarks the LLMMealPlanAgent inference backends: load time, tokens/sec and peak RSS
+# each backend runs in its own subprocess so the peak RSS of one does not leak into the next
+# usage: python bench_llm.py compare --backends bnb4 --backends cpu-int8 --backends onnx --device cpu
+
+import json
+import resource
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+import typer #type: ignore
+
+app = typer.Typer()
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@app.command()
+def single(backend: str = typer.Option(...),
+           model: str = typer.Option("mistralai/Mistral-7B-Instruct-v0.3"),
+           device: str = typer.Option("cpu"),
+           threads: Optional[int] = typer.Option(None),
+           max_new_tokens: int = typer.Option(256),
+           diet: str = typer.Option("vegetarian")):
+    """
+    Benchmark one backend in this process and print a JSON result line.
+    """
+    import torch #type: ignore
+    from llm_agent import LLMMealPlanAgent
+
+    start = time.perf_counter()
+    agent = LLMMealPlanAgent(model_name=model, device=device, backend=backend, threads=threads)
+    agent.load()
+    load_s = time.perf_counter() - start
+
+    inputs = agent.tokenizer(agent.build_prompt(diet), return_tensors="pt")
+    inputs = {k: v.to(agent.device) for k, v in inputs.items()}
+    prompt_len = inputs["input_ids"].shape[1]
+
+    # greedy with a fixed budget so every backend decodes the same number of tokens
+    start = time.perf_counter()
+    with torch.inference_mode():
+        outputs = agent.model.generate(**inputs, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False)
+    gen_s = time.perf_counter() - start
+    new_tokens = outputs.shape[1] - prompt_len
+
+    print(json.dumps({
+        "backend": agent.backend,
+        "threads": torch.get_num_threads(),
+        "load_s": round(load_s, 2),
+        "new_tokens": int(new_tokens),
+        "gen_s": round(gen_s, 2),
+        "tokens_per_s": round(new_tokens / gen_s, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }))
+
+
+@app.command()
+def compare(backends: List[str] = typer.Option(["bnb4", "cpu-int8", "onnx"]),
+            model: str = typer.Option("mistralai/Mistral-7B-Instruct-v0.3"),
+            device: str = typer.Option("cpu"),
+            threads: Optional[int] = typer.Option(None),
+            max_new_tokens: int = typer.Option(256)):
+    """
+    Run every backend in a fresh subprocess and print a comparison table.
+    """
+    results = []
+    for backend in backends:
+        cmd = [sys.executable, __file__, "single", "--backend", backend, "--model", model,
+               "--device", device, "--max-new-tokens", str(max_new_tokens)]
+        if threads:
+            cmd += ["--threads", str(threads)]
+        print(f"Benchmarking {backend}...")
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        lines = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+        if proc.returncode != 0 or not lines:
+            print(f"[ERROR] {backend} failed:\n{proc.stderr[-2000:]}")
+            continue
+        results.append(json.loads(lines[-1]))
+
+    typer.echo(f"\n{'backend':<10}{'threads':>8}{'load s':>9}{'tok/s':>9}{'peak RSS MB':>13}")
+    for r in results:
+        typer.echo(f"{r['backend']:<10}{r['threads']:>8}{r['load_s']:>9}{r['tokens_per_s']:>9}{r['peak_rss_mb']:>13}")
+
+
+if __name__ == "__main__":
+    app()
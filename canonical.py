@@ -0,0 +1,163 @@
+# ingredient canonicalization, maps raw ingredient names ("2 cups Chopped Scallions", "green onions") to one canonical
+# ingredient id and name ("green onion") so the collector, persistence and nutrition stages all key on the same thing
+# raw -> canonical mappings are persisted in ingredient_aliases and held in an in-process dict, text normalization is memoized
+# only PersistenceAgent writes new ingredients / aliases, every other stage looks names up read-only
+
+import re
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event, text #type: ignore
+from sqlalchemy.orm import Session #type: ignore
+from db import SessionLocal, CanonicalIngredient, IngredientAlias
+
+# precompiled once, these were re-compiled from strings on every NutritionAgent.normalize call
+QUANTITY_RE = re.compile(r"\b\d*\.?\d+\s*[a-zA-Z]+\b") # "1.0 cup", "2 grams"
+DESCRIPTOR_RE = re.compile(
+    r"\b(organic|fresh|large|small|sliced|diced|chopped|minced|grilled|roasted|pan-fried|fried|baked|boiled|cooked)\b",
+    re.IGNORECASE,
+)
+NON_LETTER_RE = re.compile(r"[^a-zA-Z\s]")
+SPACES_RE = re.compile(r"\s+")
+PENDING_KEY = "canonical_pending" # session.info key for rows created by resolve() but not yet committed
+
+# words that look plural but are not, or whose singular is irregular
+PLURAL_EXCEPTIONS = {"molasses": "molasses", "grits": "grits", "oats": "oats", "greens": "greens", "hummus": "hummus",
+                     "leaves": "leaf", "loaves": "loaf", "halves": "half", "cookies": "cookie"}
+
+# synonyms applied by lookup() (singular forms, plurals are singularized first), persisted as aliases by resolve()
+SEED_SYNONYMS = {
+    "scallion": "green onion",
+    "spring onion": "green onion",
+    "garbanzo bean": "chickpea",
+    "courgette": "zucchini",
+    "aubergine": "eggplant",
+    "capsicum": "bell pepper",
+    "coriander leaf": "cilantro",
+    "rocket": "arugula",
+    "prawn": "shrimp",
+    "caster sugar": "sugar",
+    "icing sugar": "powdered sugar",
+    "beef mince": "ground beef",
+}
+
+
+@lru_cache(maxsize=65536)
+def normalize_name(name: str) -> str:
+    """Strips quantities, descriptors and punctuation, lowercased. Pure text, memoized per raw name."""
+    name = QUANTITY_RE.sub("", name)
+    name = DESCRIPTOR_RE.sub("", name)
+    name = NON_LETTER_RE.sub("", name)
+    return SPACES_RE.sub(" ", name).strip().lower()
+
+
+def singularize(name: str) -> str:
+    """Singularizes the last word of a normalized name ("cherry tomatoes" -> "cherry tomato")."""
+    head, _, word = name.rpartition(" ")
+    if word in PLURAL_EXCEPTIONS:
+        word = PLURAL_EXCEPTIONS[word]
+    elif len(word) <= 3 or not word.endswith("s") or word.endswith(("ss", "us", "is")):
+        pass
+    elif word.endswith("ies") and len(word) > 4:
+        word = word[:-3] + "y"
+    elif word.endswith(("oes", "ches", "shes", "xes", "sses")):
+        word = word[:-2]
+    else:
+        word = word[:-1]
+    return f"{head} {word}" if head else word
+
+
+class Canonicalizer:
+    """
+    lookup() is read-only (dict hits, singularizing and seeded synonyms) and is what normalization uses.
+    resolve() also creates missing ingredients and aliases on the caller's session, they reach the in-process
+    dicts only when that session commits, so a rolled-back persist leaves nothing behind.
+    """
+    _shared: Optional["Canonicalizer"] = None
+
+    def __init__(self, aliases: Dict[str, int], names: Dict[int, str]):
+        self.aliases = aliases # normalized raw name -> ingredient id
+        self.names = names     # ingredient id -> canonical name
+
+    @classmethod
+    def shared(cls) -> "Canonicalizer":
+        """Process-wide instance, loads ingredient_aliases on first use."""
+        if cls._shared is None:
+            cls._shared = cls.load()
+        return cls._shared
+
+    @classmethod
+    def load(cls) -> "Canonicalizer":
+        with SessionLocal() as session:
+            names = dict(session.query(CanonicalIngredient.id, CanonicalIngredient.name).all())
+            aliases = {alias.lower(): ing_id for alias, ing_id in
+                       session.query(IngredientAlias.alias, IngredientAlias.ingredient_id).yield_per(20000)}
+        print(f"Loaded {len(aliases)} ingredient aliases for {len(names)} canonical ingredients")
+        return cls(aliases, names)
+
+    def lookup(self, raw_name: str) -> Tuple[Optional[int], str]:
+        """
+        Returns (ingredient id, canonical name) without touching the database. A name not stored yet gets
+        id None and the canonical name resolve() would create it under (singularized, seeded synonyms applied).
+        Names that normalize to nothing return (None, "").
+        """
+        key = normalize_name(raw_name)
+        ing_id = self.aliases.get(key)
+        if ing_id is not None:
+            return ing_id, self.names[ing_id]
+        if not key:
+            return None, ""
+        name = singularize(key)
+        name = SEED_SYNONYMS.get(name, name)
+        ing_id = self.aliases.get(name)
+        return ing_id, self.names[ing_id] if ing_id is not None else name
+
+    def canonical_name(self, raw_name: str) -> str:
+        return self.lookup(raw_name)[1]
+
+    def resolve(self, session: Session, raw_name: str) -> Tuple[Optional[int], str]:
+        """Like lookup(), but creates the ingredient and the raw name's alias on the caller's session when missing."""
+        ing_id, name = self.lookup(raw_name)
+        if not name:
+            return None, ""
+        pending = session.info.setdefault(PENDING_KEY, {"names": {}, "aliases": {}})
+        if ing_id is None:
+            ing_id = pending["aliases"].get(name)
+            if ing_id is None:
+                ing_id = self.create(session, name)
+        key = normalize_name(raw_name)
+        if key not in self.aliases and key not in pending["aliases"]:
+            self.add_alias(session, key, ing_id)
+        return ing_id, name
+
+    def create(self, session: Session, name: str) -> int:
+        # another process may have created it first, so insert-or-select and register the name as its own alias
+        session.execute(text("INSERT INTO ingredients (name) VALUES (:name) ON CONFLICT (name) DO NOTHING"), {"name": name})
+        ing_id, stored = session.execute(text("SELECT id, name FROM ingredients WHERE name = :name"), {"name": name}).one()
+        session.info[PENDING_KEY]["names"][ing_id] = stored
+        if name not in self.aliases:
+            self.add_alias(session, name, ing_id)
+        return ing_id
+
+    def add_alias(self, session: Session, alias: str, ing_id: int):
+        session.execute(
+            text("INSERT INTO ingredient_aliases (alias, ingredient_id) VALUES (:alias, :id) ON CONFLICT (alias) DO NOTHING"),
+            {"alias": alias, "id": ing_id},
+        )
+        session.info.setdefault(PENDING_KEY, {"names": {}, "aliases": {}})["aliases"][alias] = ing_id
+
+    def apply(self, pending: dict):
+        self.names.update(pending["names"])
+        self.aliases.update(pending["aliases"])
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_pending(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending and Canonicalizer._shared is not None:
+        Canonicalizer._shared.apply(pending)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _drop_pending(session):
+    session.info.pop(PENDING_KEY, None)
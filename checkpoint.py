@@ -0,0 +1,42 @@
+# durable per-run checkpoints for the orchestrator in cli.py
+# after each agent the context is written as a snapshot under CHECKPOINT_DIR/<run_id>/, so a failed run
+# can be resumed from the last completed stage instead of starting over (and regenerating the plan)
+
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from snapshot import SnapshotDir
+
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+CONFIG_NAME = "config"
+
+
+class CheckpointStore:
+    def __init__(self, run_id: Optional[str] = None, root: str = CHECKPOINT_DIR):
+        self.run_id = run_id or str(uuid.uuid4())
+        self.snapshots = SnapshotDir(str(Path(root) / self.run_id))
+
+    @staticmethod
+    def exists(run_id: str, root: str = CHECKPOINT_DIR) -> bool:
+        return (Path(root) / run_id).is_dir()
+
+    def save_config(self, config: Dict[str, Any]):
+        # the CLI options the run was started with, so resume can rebuild the same agents
+        self.snapshots.save(config, CONFIG_NAME)
+
+    def load_config(self) -> Dict[str, Any]:
+        return self.snapshots.load(CONFIG_NAME)
+
+    def save(self, ctx: Dict[str, Any], stage: str):
+        # stage snapshots are prefixed with their position so they sort in pipeline order
+        position = len(ctx.get("completed_stages", []))
+        self.snapshots.save(ctx, f"{position:02d}_{stage}", compress=True)
+
+    def latest(self) -> Optional[Dict[str, Any]]:
+        """Returns the context saved after the last completed stage, or None if no stage finished."""
+        stages = [n for n in self.snapshots.names() if n != CONFIG_NAME]
+        if not stages:
+            return None
+        return self.snapshots.load(stages[-1])
@@ -1,43 +1,66 @@
 # defines a command-line interface for the grocery bot application using Typer
 # This CLI allows users to generate a weekly meal plan and shopping list based on dietary preferences.
-# command line arguments include dietary tags, model name, and device type (CPU or GPU). 
+# command line arguments include dietary tags, model name, and device type (CPU or GPU).
 
+import json
+import uuid
 import typer #type: ignore
 from llm_agent import LLMMealPlanAgent
 from collector_agent import IngredientCollectorAgent
 from agent import Agent
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Tuple, Optional
 from persistence_agent import PersistenceAgent
 from nutrition_agent import NutritionAgent
-#from query_agent import QueryAgent
+from checkpoint import CheckpointStore
+from retrieval_agent import RetrievalPlanAgent
+from product_agent import ProductMatchAgent
+from models import WeeklyPlan, parse_tags
+from query_agent import QueryAgent
 
 app = typer.Typer()
+query_app = typer.Typer(help="Read saved plans and meals")
+app.add_typer(query_app, name="query")
+
+#builds the (stage name, agent factory) pairs for the pipeline
+#agents are created lazily so a resumed run never loads the LLM for a stage that already finished
+#with retrieve, meals are composed from the stored catalogue first and the LLM only fills the remaining slots
+def build_stages(model: str, device: str, backend: str = "auto", threads: Optional[int] = None,
+                 draft: Optional[str] = None, draft_tokens: int = 10,
+                 retrieve: bool = False, catalogue: Optional[str] = None,
+                 reference_prompt: bool = False) -> List[Tuple[str, Callable[[], Agent]]]:
+    retrieval = [("retrieval", RetrievalPlanAgent)] if retrieve else []
+    products = [("products", lambda: ProductMatchAgent(catalogue))] if catalogue else []
+    return retrieval + [
+        ("mealplan", lambda: LLMMealPlanAgent(model_name=model, device=device, backend=backend, threads=threads,
+                                              draft=draft, draft_tokens=draft_tokens,
+                                              reference_prompt=reference_prompt)),
+        ("ingredients", IngredientCollectorAgent),
+        ("persistence", PersistenceAgent),
+        ("nutrition", NutritionAgent),
+    ] + products
 
 #coordinates the execution of multiple agents in sequence
 #each agent modifies the context dictionary, which is passed to the next agent
-def orchestrate(agents: List[Agent], init_ctx: Dict[str, Any]) -> Dict[str, Any]:
+#stages already listed in ctx["completed_stages"] are skipped, and if a store is given the context is checkpointed after each stage
+def orchestrate(stages: List[Tuple[str, Callable[[], Agent]]], init_ctx: Dict[str, Any],
+                store: Optional[CheckpointStore] = None) -> Dict[str, Any]:
     ctx = init_ctx.copy()
-    for agent in agents:
+    completed = list(ctx.get("completed_stages", []))
+    for name, factory in stages:
+        if name in completed:
+            print(f"Skipping completed stage: {name}")
+            continue
+        agent = factory()
         print(f"Running agent: {agent.__class__.__name__}")
         ctx = agent.run(ctx) #passes context to each agent's run method
+        completed.append(name)
+        ctx["completed_stages"] = completed
+        if store:
+            store.save(ctx, name)
         print(f"Context after {agent.__class__.__name__}: {ctx}")
     return ctx
 
-#receives diet, model, and device as command line options
-@app.command()
-def plan(diet: str = typer.Option("", help="Dietary tags: vegan, keto, etc."),
-         model: str = typer.Option("mistralai/Mistral-7B-Instruct-v0.3", help="HuggingFace model name"),
-         device: str = typer.Option("cpu", help="cpu or cuda")):
-    """
-    Generate weekly meal plan & shopping list by creating two agent objects. Then persist the results.
-    """
-    agents = [
-        LLMMealPlanAgent(model_name=model, device=device),
-        IngredientCollectorAgent(),
-        PersistenceAgent(),
-        NutritionAgent()
-    ]
-    result = orchestrate(agents, {"dietary_tags": diet})
+def print_result(result: Dict[str, Any]):
     # Print in a readable way
     typer.echo(f"Saved plan with ID: {result['db_plan_id']}")
     typer.echo("Weekly Plan:")
@@ -46,10 +69,225 @@ def plan(diet: str = typer.Option("", help="Dietary tags: vegan, keto, etc."),
     else:
         typer.echo("No weekly plan generated.")
 
+    for stats in result.get("decode_stats", []):
+        typer.echo(f"Decode: {stats}")
+
     typer.echo("\nShopping List:")
     for ing in result["shopping_list"]:
         typer.echo(f"- {ing.quantity} {ing.unit} {ing.name}")
 
+    if "basket" in result:
+        print_basket(result["basket"], result["unmatched_items"], result["basket_total"])
+
+def print_basket(basket: List[dict], unmatched: List[tuple], total: float):
+    typer.echo("\nBasket:")
+    for m in basket:
+        packs = ", ".join(f"{p['count']} x {p['name']} ({p['sku']})" for p in m["packs"])
+        typer.echo(f"- {m['item']}: {packs} = {m['cost']:.2f}")
+    for name, qty, unit in unmatched:
+        typer.echo(f"- {name}: no match for {qty} {unit}")
+    typer.echo(f"Total: {total:.2f}")
+
+def run_checkpointed(store: CheckpointStore, stages, ctx: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        return orchestrate(stages, ctx, store=store)
+    except Exception:
+        typer.echo(f"Run {store.run_id} failed. Continue it with: python cli.py resume {store.run_id}", err=True)
+        raise
+
+#receives diet, model, and device as command line options
+@app.command()
+def plan(diet: str = typer.Option("", help="Dietary tags: vegan, keto, etc."),
+         model: str = typer.Option("mistralai/Mistral-7B-Instruct-v0.3", help="HuggingFace model name"),
+         device: str = typer.Option("cpu", help="cpu or cuda"),
+         backend: str = typer.Option("auto", help="Inference backend: auto, bnb4 (CUDA 4-bit), cpu-int8 or onnx"),
+         threads: Optional[int] = typer.Option(None, help="CPU threads used for inference"),
+         draft: Optional[str] = typer.Option(None, help="Speculative decoding: 'prompt-lookup' or a small draft model name"),
+         draft_tokens: int = typer.Option(10, help="Tokens proposed by the drafter per verification step"),
+         reference_prompt: bool = typer.Option(False, help="Add the last accepted plan to the prompt as a format reference (helps prompt lookup, changes outputs)"),
+         retrieve: bool = typer.Option(False, help="Compose the plan from stored meals, generating only unfilled slots"),
+         catalogue: Optional[str] = typer.Option(None, help="Retailer catalogue (CSV/JSONL) to match the shopping list against"),
+         calories: Optional[float] = typer.Option(None, help="Daily calorie target (kcal)"),
+         protein: Optional[float] = typer.Option(None, help="Daily protein target (g)"),
+         fat: Optional[float] = typer.Option(None, help="Daily fat target (g)"),
+         carbs: Optional[float] = typer.Option(None, help="Daily carbohydrate target (g)"),
+         fibre: Optional[float] = typer.Option(None, help="Daily fibre target (g)"),
+         candidates: int = typer.Option(1, help="Plans generated per attempt, the one closest to the targets is kept")):
+    """
+    Generate weekly meal plan & shopping list by creating two agent objects. Then persist the results.
+    """
+    targets = {
+        k: v for k, v in
+        {"energy_kcal": calories, "protein_g": protein, "fat_g": fat, "carbs_g": carbs, "fibre_g": fibre}.items()
+        if v is not None
+    }
+    store = CheckpointStore()
+    store.save_config({"diet": diet, "model": model, "device": device, "backend": backend, "threads": threads,
+                       "draft": draft, "draft_tokens": draft_tokens, "retrieve": retrieve, "catalogue": catalogue,
+                       "targets": targets, "candidates": candidates, "reference_prompt": reference_prompt})
+    typer.echo(f"Run ID: {store.run_id}")
+    stages = build_stages(model, device, backend, threads, draft, draft_tokens, retrieve, catalogue, reference_prompt)
+    result = run_checkpointed(store, stages,
+                              initial_ctx(store.run_id, store.load_config()))
+    print_result(result)
+
+def initial_ctx(run_id: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "dietary_tags": config["diet"],
+        "run_id": run_id,
+        "nutrition_targets": config.get("targets", {}),
+        "num_candidates": config.get("candidates", 1),
+    }
+
+@app.command()
+def resume(run_id: str = typer.Argument(..., help="Run ID printed by the plan command")):
+    """
+    Continue a checkpointed run from its last completed stage.
+    """
+    if not CheckpointStore.exists(run_id):
+        raise typer.BadParameter(f"No checkpoints found for run {run_id}")
+    store = CheckpointStore(run_id)
+    config = store.load_config()
+    ctx = store.latest() or initial_ctx(run_id, config)
+    typer.echo(f"Resuming run {run_id}, completed stages: {ctx.get('completed_stages', [])}")
+    stages = build_stages(config["model"], config["device"], config.get("backend", "auto"), config.get("threads"),
+                          config.get("draft"), config.get("draft_tokens", 10), config.get("retrieve", False),
+                          config.get("catalogue"), config.get("reference_prompt", False))
+    result = run_checkpointed(store, stages, ctx)
+    print_result(result)
+
+@app.command()
+def migrate():
+    """
+    Apply schema upgrades (columns, indexes, triggers) to an existing database, run once after each deploy.
+    """
+    from db import migrate as run_migrations
+    typer.echo(f"Applied {run_migrations()} schema statements")
+
+@app.command()
+def recompute(batch_size: int = typer.Option(500, help="Meals costed per transaction"),
+              full: bool = typer.Option(False, help="Re-cost every meal, not just the changed ones")):
+    """
+    Re-cost only the meals affected by nutrition_lookup corrections or ingredient changes since the last run.
+    """
+    stats = NutritionAgent().recompute(batch_size=batch_size, full=full)
+    typer.echo(f"Lookup rows moved to canonical ingredient names: {stats['lookup_rekeyed']}")
+    typer.echo(f"Previously costed ingredients linked to lookup rows: {stats['legacy_linked']}")
+    typer.echo(f"Meals affected by lookup corrections: {stats['stale_meals']}")
+    typer.echo(f"Meals recomputed: {stats['meals_recomputed']}")
+
+@app.command()
+def correct(name: str = typer.Argument(..., help="Ingredient name in nutrition_lookup"),
+            calories: float = typer.Argument(..., help="Corrected kcal per 100g"),
+            fdc_id: str = typer.Option(None, help="Corrected USDA FDC id")):
+    """
+    Correct a nutrition_lookup entry, affected meals are re-costed by the next recompute.
+    """
+    version = NutritionAgent().correct_lookup(name, calories, fdc_id)
+    typer.echo(f"Updated '{name}' to {calories} kcal/100g (version {version})")
+
+@app.command()
+def macros(plan_id: str = typer.Argument(..., help="Meal plan ID")):
+    """
+    Print per-day and weekly macro-nutrient totals for a saved plan.
+    """
+    from db import SessionLocal, MealPlan
+    agent = NutritionAgent()
+    with SessionLocal() as session:
+        db_plan = session.get(MealPlan, uuid.UUID(plan_id))
+        if db_plan is None:
+            raise typer.BadParameter(f"No plan with ID {plan_id}")
+        plan_json = db_plan.plan_json
+        if isinstance(plan_json, str): # older plans were stored as a JSON string
+            plan_json = json.loads(plan_json)
+        report = agent.macro_report(session, WeeklyPlan.parse_obj(plan_json))
+        session.commit() # keeps any vectors/grams backfilled while building the report
+
+    header = "".join(f"{n:>14}" for n in report["nutrients"])
+    typer.echo(f"{'':<12}{header}")
+    for day, vec in report["days"].items():
+        typer.echo(f"{day:<12}" + "".join(f"{v:>14.1f}" for v in vec))
+    typer.echo(f"{'Week':<12}" + "".join(f"{v:>14.1f}" for v in report["week"]))
+    if report["missing"]:
+        typer.echo(f"({report['missing']} ingredients not costed yet, run recompute first)")
+
+@app.command()
+def match(plan_id: str = typer.Argument(..., help="Meal plan ID"),
+          catalogue: str = typer.Option(..., help="Retailer catalogue (CSV/JSONL)")):
+    """
+    Match a saved plan's shopping list against a local retailer catalogue.
+    """
+    from db import SessionLocal, ShoppingItem
+    with SessionLocal() as session:
+        items = session.query(ShoppingItem).filter_by(plan_id=uuid.UUID(plan_id)).all()
+    result = ProductMatchAgent(catalogue).run({"shopping_list": items})
+    print_basket(result["basket"], result["unmatched_items"], result["basket_total"])
+
+def echo_page(rows: List[dict], next_cursor: Optional[str]):
+    typer.echo(json.dumps(rows, indent=2, default=str))
+    if next_cursor:
+        typer.echo(f"Next page: --cursor '{next_cursor}'")
+
+@query_app.command("plan")
+def query_plan(plan_id: str = typer.Argument(..., help="Meal plan ID")):
+    """
+    Show a plan with its shopping list and nutrition.
+    """
+    result = QueryAgent().get_plan(plan_id)
+    if result is None:
+        raise typer.BadParameter(f"No plan with ID {plan_id}")
+    typer.echo(json.dumps(result, indent=2, default=str))
+
+@query_app.command("ingredient")
+def query_ingredient(name: str = typer.Argument(..., help="Ingredient name"),
+                     fuzzy: bool = typer.Option(False, help="Substring match instead of exact"),
+                     limit: int = typer.Option(50),
+                     cursor: Optional[str] = typer.Option(None, help="Cursor from the previous page")):
+    """
+    Find meals containing an ingredient.
+    """
+    echo_page(*QueryAgent().meals_with_ingredient(name, fuzzy=fuzzy, limit=limit, cursor=cursor))
+
+@query_app.command("tag")
+def query_tag(tags: List[str] = typer.Argument(..., help="Dietary tags the plans must all have"),
+              limit: int = typer.Option(50),
+              cursor: Optional[str] = typer.Option(None, help="Cursor from the previous page")):
+    """
+    Find plans by dietary tag, newest first.
+    """
+    echo_page(*QueryAgent().plans_by_tag(parse_tags(tags), limit=limit, cursor=cursor))
+
+@query_app.command("meal")
+def query_meal(name: str = typer.Argument(..., help="Exact meal name"),
+               limit: int = typer.Option(50),
+               cursor: Optional[str] = typer.Option(None, help="Cursor from the previous page")):
+    """
+    Find plans that use a meal, newest first.
+    """
+    echo_page(*QueryAgent().plans_with_meal(name, limit=limit, cursor=cursor))
+
+@query_app.command("fix-legacy-plans")
+def query_fix_legacy_plans():
+    """
+    Convert plans stored as JSON strings into JSON objects so meal lookups (query meal) find them.
+    """
+    typer.echo(f"Converted {QueryAgent().fix_legacy_plans()} plans")
+
+@app.command()
+def dedup(apply: bool = typer.Option(False, help="Merge the duplicates (default only reports)")):
+    """
+    Find near-duplicate meals across the whole meals table and optionally merge them onto canonical meals.
+    Also indexes meals stored before meal_signature_bands existed, so PersistenceAgent can match new meals against them.
+    """
+    from dedup import rebuild
+    stats = rebuild(apply=apply)
+    typer.echo(f"Meals scanned: {stats['meals']}")
+    typer.echo(f"Duplicate clusters: {stats['clusters']}")
+    typer.echo(f"Meals rows {'removed' if apply else 'removable'}: {stats['meals_removed']}")
+    typer.echo(f"Meal ingredient rows {'removed' if apply else 'removable'}: {stats['ingredient_rows_removed']}")
+    typer.echo(f"Uncosted ingredients NutritionAgent no longer has to cost: {stats['uncosted_ingredients_avoided']}")
+    typer.echo(f"Meals added to the near-duplicate index: {stats['meals_indexed']}")
+
 # execute the app when this script is run directly
 if __name__ == "__main__":
-    app()
\ No newline at end of file
+    app()
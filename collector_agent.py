@@ -1,25 +1,40 @@
 # this clas generates a shopping list from a weekly meal plan by aggregating ingredients from each meal
 
-from models import Ingredient
+from models import Ingredient, construct
 from agent import Agent
+from compact_plan import CompactPlan, INGREDIENT_NAMES, UNITS
+from canonical import Canonicalizer
 
-#requires context to have a weekly_plan key with WeeklyPlan object
+#requires context to have a weekly_plan key with WeeklyPlan or CompactPlan object
 class IngredientCollectorAgent(Agent):
     def run(self, context): 
         plan = context["weekly_plan"] # context dictionary stores plan and will store shopping list
+
+        canon = Canonicalizer.shared()
         agg = {} #for collecting ingredients
-        
-        # for each day in the weekly plan, for each meal, for each ingredient, aggregate quantities
-        for day in plan.days.values():
-            for meal in day.values():
-                for ing in meal.ingredients: #for each ingredient creates a key using the name and unit
-                    key = (ing.name.lower(), ing.unit) 
-                    agg[key] = agg.get(key, 0) + ing.quantity # adds quantity to the existing key
 
-        # creates list of ingredient objects from the aggregated dictionary
+        # lines are merged on (canonical name, unit), one name per canonical ingredient id, so "Scallions" and
+        # "green onions" become one item. read-only, PersistenceAgent creates ingredients that are new
+        def add(raw_name, unit, qty):
+            name = canon.canonical_name(raw_name) or raw_name.lower() # nothing left after normalization, keep the raw name
+            key = (name, unit)
+            agg[key] = agg.get(key, 0) + qty # adds quantity to the existing key
+
+        # compact plans pre-aggregate straight from their arrays, keyed on interned ids
+        if isinstance(plan, CompactPlan):
+            for (name_id, unit_id), qty in plan.aggregate().items():
+                add(INGREDIENT_NAMES[name_id], UNITS[unit_id], qty)
+        else:
+            # for each day in the weekly plan, for each meal, for each ingredient, aggregate quantities
+            for day in plan.days.values():
+                for meal in day.values():
+                    for ing in meal.ingredients:
+                        add(ing.name, ing.unit, ing.quantity)
+
+        # creates list of ingredient objects from the aggregated dictionary (inputs were already validated)
         # stores this in context under "shopping_list" key
         context["shopping_list"] = [
-            Ingredient(name=name, unit=unit, quantity=qty)
+            construct(Ingredient, name=name, unit=unit, quantity=qty)
             for (name, unit), qty in agg.items()
         ]
         return context
\ No newline at end of file
@@ -0,0 +1,156 @@
+# struct-of-arrays weekly plan for holding tens of thousands of plans in memory (batch aggregation, replay)
+# meals and ingredient lines live in flat typed arrays, names and units are interned once per process in shared
+# string pools, and standard days / meal slots have fixed indices. conversion to and from WeeklyPlan skips validation
+
+import json
+from array import array
+from collections import namedtuple
+from typing import Dict, Iterator, List, Tuple, Union
+
+from models import Ingredient, Meal, WeeklyPlan, construct
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+SLOTS = ["breakfast", "lunch", "dinner"]
+
+# light duck-typed stand-ins for Meal / Ingredient, used when agents iterate a CompactPlan
+MealView = namedtuple("MealView", ["name", "ingredients"])
+IngredientView = namedtuple("IngredientView", ["name", "quantity", "unit"])
+
+
+class StringPool:
+    """Interns strings to small integer ids, shared by every CompactPlan."""
+    def __init__(self, seed: List[str] = (), track_lower: bool = False):
+        self.strings: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.track_lower = track_lower
+        self.lower: List[int] = [] # id -> id of the lowercased string, when track_lower
+        for s in seed:
+            self.intern(s)
+
+    def intern(self, s: str) -> int:
+        i = self.ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.ids[s] = i
+            self.strings.append(s)
+            if self.track_lower:
+                self.lower.append(i) # placeholder until the lowercase string has an id
+                low = s.lower()
+                if low != s:
+                    self.lower[i] = self.intern(low)
+        return i
+
+    def __getitem__(self, i: int) -> str:
+        return self.strings[i]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
+# process-wide pools, standard days and slots are seeded first so their ids are fixed
+DAYS = StringPool(WEEKDAYS)
+MEAL_SLOTS = StringPool(SLOTS)
+MEAL_NAMES = StringPool()
+INGREDIENT_NAMES = StringPool(track_lower=True)
+UNITS = StringPool(["g", "ml"])
+
+
+class CompactPlan:
+    """
+    One plan as parallel arrays. Meal i has day meal_day[i], slot meal_slot[i], name meal_name[i], and owns
+    ingredient lines ing_start[i]:ing_start[i + 1] of ing_name / ing_unit / ing_qty (CSR layout).
+    """
+    __slots__ = ("meal_day", "meal_slot", "meal_name", "ing_start", "ing_name", "ing_unit", "ing_qty")
+
+    def __init__(self):
+        # the day / slot pools are process-wide and grow with every non-standard key an LLM invents, so 16-bit like units
+        self.meal_day = array("H")
+        self.meal_slot = array("H")
+        self.meal_name = array("I")
+        self.ing_start = array("I", [0])
+        self.ing_name = array("I")
+        self.ing_unit = array("H")
+        self.ing_qty = array("d")
+
+    def add_meal(self, day: str, slot: str, name: str, ingredients: List[Tuple[str, float, str]]):
+        self.meal_day.append(DAYS.intern(day))
+        self.meal_slot.append(MEAL_SLOTS.intern(slot))
+        self.meal_name.append(MEAL_NAMES.intern(name))
+        for ing_name, qty, unit in ingredients:
+            self.ing_name.append(INGREDIENT_NAMES.intern(ing_name))
+            self.ing_unit.append(UNITS.intern(unit))
+            self.ing_qty.append(qty)
+        self.ing_start.append(len(self.ing_name))
+
+    @classmethod
+    def from_weekly_plan(cls, plan: WeeklyPlan) -> "CompactPlan":
+        compact = cls()
+        for day, meals in plan.days.items():
+            for slot, meal in meals.items():
+                compact.add_meal(day, slot, meal.name, [(i.name, i.quantity, i.unit) for i in meal.ingredients])
+        return compact
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CompactPlan":
+        """From parsed plan JSON ({"days": {...}}, e.g. meal_plans.plan_json), without building pydantic models."""
+        compact = cls()
+        for day, meals in data["days"].items():
+            for slot, meal in meals.items():
+                compact.add_meal(day, slot, meal["name"],
+                                 [(i["name"], float(i["quantity"]), i["unit"]) for i in meal["ingredients"]])
+        return compact
+
+    def iter_meals(self) -> Iterator[Tuple[str, str, MealView]]:
+        """Yields (day, slot, MealView) in insertion order."""
+        for i in range(len(self.meal_name)):
+            start, end = self.ing_start[i], self.ing_start[i + 1]
+            ingredients = [
+                IngredientView(INGREDIENT_NAMES[self.ing_name[j]], self.ing_qty[j], UNITS[self.ing_unit[j]])
+                for j in range(start, end)
+            ]
+            yield DAYS[self.meal_day[i]], MEAL_SLOTS[self.meal_slot[i]], MealView(MEAL_NAMES[self.meal_name[i]], ingredients)
+
+    def aggregate(self) -> Dict[Tuple[int, int], float]:
+        """Total quantity per (lowercased ingredient name id, unit id), straight from the arrays."""
+        agg = {}
+        lower = INGREDIENT_NAMES.lower
+        for name_id, unit_id, qty in zip(self.ing_name, self.ing_unit, self.ing_qty):
+            key = (lower[name_id], unit_id)
+            agg[key] = agg.get(key, 0) + qty
+        return agg
+
+    def to_dict(self) -> dict:
+        days = {}
+        for day, slot, meal in self.iter_meals():
+            days.setdefault(day, {})[slot] = {
+                "name": meal.name,
+                "ingredients": [{"name": i.name, "quantity": i.quantity, "unit": i.unit} for i in meal.ingredients],
+            }
+        return {"days": days}
+
+    def json(self) -> str:
+        # same shape as WeeklyPlan.json()
+        return json.dumps(self.to_dict())
+
+    def to_weekly_plan(self) -> WeeklyPlan:
+        days = {}
+        for day, slot, meal in self.iter_meals():
+            days.setdefault(day, {})[slot] = construct(Meal, name=meal.name, ingredients=[
+                construct(Ingredient, name=i.name, quantity=i.quantity, unit=i.unit) for i in meal.ingredients
+            ])
+        return construct(WeeklyPlan, days=days)
+
+    def nbytes(self) -> int:
+        return sum(a.itemsize * len(a) for a in (
+            self.meal_day, self.meal_slot, self.meal_name, self.ing_start, self.ing_name, self.ing_unit, self.ing_qty
+        ))
+
+
+def iter_meals(plan: Union[WeeklyPlan, CompactPlan]) -> Iterator[tuple]:
+    """(day, slot, meal) for either plan representation, meals expose .name and .ingredients either way."""
+    if isinstance(plan, CompactPlan):
+        yield from plan.iter_meals()
+        return
+    for day, meals in plan.days.items():
+        for slot, meal in meals.items():
+            yield day, slot, meal
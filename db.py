@@ -4,13 +4,16 @@ import os
 import uuid
 
 from sqlalchemy import ( #type: ignore
+    BigInteger,
     Column,
     DateTime,
     Float,
     ForeignKey,
+    Integer,
     func,
     create_engine,
     PrimaryKeyConstraint,
+    text,
 ) 
 from sqlalchemy.dialects.postgresql import UUID, ARRAY, TEXT, CITEXT, JSONB #type: ignore
 from sqlalchemy.ext.declarative import declarative_base #type: ignore
@@ -64,7 +67,7 @@ class Meal(Base):
     )
     meal_name = Column(CITEXT, unique=True, nullable=False)
     description = Column(CITEXT, nullable=True)
-    calories_total = Column(Float, nullable=True)
+    calories_total = Column(Float, nullable=True) # NULL marks the meal as dirty (needs costing)
 
     ingredients = relationship(
         "MealIngredient",
@@ -91,6 +94,11 @@ class MealIngredient(Base):
     fdc_id = Column(TEXT, nullable=True)
     cals_per_100g = Column(Float, nullable=True)
     cals_total = Column(Float, nullable=True)
+    grams = Column(Float, nullable=True) # quantity converted to grams when costed
+    # the nutrition_lookup row (and its version) the cals were taken from, used to find stale costings
+    lookup_name = Column(CITEXT, nullable=True)
+    lookup_version = Column(Integer, nullable=True)
+    ingredient_id = Column(Integer, ForeignKey("ingredients.id"), nullable=True)
 
     meal = relationship("Meal", back_populates="ingredients")
 
@@ -109,9 +117,54 @@ class ShoppingItem(Base):
     name = Column(CITEXT, nullable=False)
     quantity = Column(Float, nullable=False)
     unit = Column(CITEXT, nullable=False)
+    ingredient_id = Column(Integer, ForeignKey("ingredients.id"), nullable=True)
 
     plan = relationship("MealPlan", back_populates="shopping_items")
 
+# Meal Alias ORM model, names of near-duplicate meals merged onto a canonical meal
+class MealAlias(Base):
+    __tablename__ = "meal_aliases"
+
+    alias = Column(CITEXT, primary_key=True, nullable=False)
+    meal_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("meals.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+
+# LSH band buckets of each meal's MinHash signature (see dedup.py), so near-duplicate candidates are one indexed query
+class MealSignatureBand(Base):
+    __tablename__ = "meal_signature_bands"
+    __table_args__ = (
+        PrimaryKeyConstraint("meal_id", "band", name="pk_meal_signature_band"),
+    )
+
+    meal_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("meals.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    band = Column(Integer, nullable=False)
+    bucket = Column(BigInteger, nullable=False)
+
+# Canonical ingredient ORM model, one row per distinct ingredient (see canonical.py)
+class CanonicalIngredient(Base):
+    __tablename__ = "ingredients"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(CITEXT, unique=True, nullable=False) # canonical name, also the nutrition_lookup key
+
+# Ingredient Alias ORM model, normalized raw names ("scallions", "spring onion") mapped to a canonical ingredient
+class IngredientAlias(Base):
+    __tablename__ = "ingredient_aliases"
+
+    alias = Column(CITEXT, primary_key=True, nullable=False)
+    ingredient_id = Column(
+        Integer,
+        ForeignKey("ingredients.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+
 class NutritionLookup(Base):
     __tablename__ = "nutrition_lookup"
 
@@ -119,6 +172,14 @@ class NutritionLookup(Base):
     raw_name = Column(TEXT, nullable=False)                     # original
     usda_fdc_id = Column(TEXT, nullable=False)
     calories_per_100g = Column(Float, nullable=False)
+    nutrients = Column(ARRAY(Float), nullable=True)             # per 100g, in nutrition_agent.NUTRIENTS order
+    # bumped by trigger whenever the calories, nutrients or fdc id are corrected
+    version = Column(Integer, server_default="1", nullable=False)
+    updated_at = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+    )
 
 
 # Database connection setup
@@ -146,4 +207,70 @@ SessionLocal = sessionmaker(
 )
 
 # base.metadata contains the definitions for all tables, will create them if thet dont exist, if they do exist it will do nothing (no alter)
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+Base.metadata.create_all(bind=engine)
+
+# create_all never alters existing tables, so columns, indexes and triggers added after the first release are applied by
+# migrate() (`python cli.py migrate`), not at import: ALTER TABLE and CREATE TRIGGER take ACCESS EXCLUSIVE locks even when
+# there is nothing to change. every statement must be safe to re-run
+SCHEMA_UPGRADES = [
+    # change tracking for incremental nutrition recomputation
+    "ALTER TABLE nutrition_lookup ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    "ALTER TABLE nutrition_lookup ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+    "ALTER TABLE meal_ingredients ADD COLUMN IF NOT EXISTS lookup_name CITEXT",
+    "ALTER TABLE meal_ingredients ADD COLUMN IF NOT EXISTS lookup_version INTEGER",
+    "CREATE INDEX IF NOT EXISTS ix_meal_ingredients_lookup_name ON meal_ingredients (lookup_name)",
+    "CREATE INDEX IF NOT EXISTS ix_meals_uncosted ON meals (id) WHERE calories_total IS NULL",
+    # macro-nutrient vectors
+    "ALTER TABLE nutrition_lookup ADD COLUMN IF NOT EXISTS nutrients DOUBLE PRECISION[]",
+    "ALTER TABLE meal_ingredients ADD COLUMN IF NOT EXISTS grams DOUBLE PRECISION",
+    # read-path indexes for query_agent
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # superseded by ix_meal_plans_meal_names, no query used it and it slowed every plan insert
+    "DROP INDEX IF EXISTS ix_meal_plans_plan_json",
+    "CREATE INDEX IF NOT EXISTS ix_meal_plans_dietary_tags ON meal_plans USING GIN (dietary_tags)",
+    "CREATE INDEX IF NOT EXISTS ix_meal_plans_created_id ON meal_plans (created_at DESC, id DESC)",
+    # lowercased meal names of a plan (any day / slot key), GIN indexed for case-insensitive meal lookups
+    """
+    CREATE OR REPLACE FUNCTION plan_meal_names(plan JSONB) RETURNS TEXT[] AS $$
+        SELECT COALESCE(array_agg(DISTINCT lower(n #>> '{}')), '{}')
+        FROM jsonb_path_query(plan, '$.days.*.*.name') AS n
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_meal_plans_meal_names ON meal_plans USING GIN (plan_meal_names(plan_json))",
+    "CREATE INDEX IF NOT EXISTS ix_meal_ingredients_name ON meal_ingredients (name)",
+    "CREATE INDEX IF NOT EXISTS ix_meal_ingredients_name_trgm ON meal_ingredients USING GIN ((name::text) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_meals_meal_name_trgm ON meals USING GIN ((meal_name::text) gin_trgm_ops)",
+    # near-duplicate meal candidates
+    "CREATE INDEX IF NOT EXISTS ix_meal_signature_bands_bucket ON meal_signature_bands (band, bucket)",
+    # canonical ingredient ids (the ingredients / ingredient_aliases tables themselves come from create_all)
+    "ALTER TABLE meal_ingredients ADD COLUMN IF NOT EXISTS ingredient_id INTEGER REFERENCES ingredients(id)",
+    "ALTER TABLE shopping_items ADD COLUMN IF NOT EXISTS ingredient_id INTEGER REFERENCES ingredients(id)",
+    "CREATE INDEX IF NOT EXISTS ix_meal_ingredients_ingredient_id ON meal_ingredients (ingredient_id)",
+    "CREATE INDEX IF NOT EXISTS ix_ingredient_aliases_ingredient_id ON ingredient_aliases (ingredient_id)",
+    """
+    CREATE OR REPLACE FUNCTION bump_nutrition_lookup_version() RETURNS trigger AS $$
+    BEGIN
+        NEW.version = OLD.version + 1;
+        NEW.updated_at = now();
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER trg_nutrition_lookup_version
+    BEFORE UPDATE OF calories_per_100g, usda_fdc_id, nutrients ON nutrition_lookup
+    FOR EACH ROW
+    WHEN (OLD.calories_per_100g IS DISTINCT FROM NEW.calories_per_100g
+          OR OLD.usda_fdc_id IS DISTINCT FROM NEW.usda_fdc_id
+          OR (OLD.nutrients IS NOT NULL AND OLD.nutrients IS DISTINCT FROM NEW.nutrients))
+    EXECUTE FUNCTION bump_nutrition_lookup_version()
+    """,
+]
+
+
+def migrate() -> int:
+    """Applies SCHEMA_UPGRADES in one transaction, run once per deploy. Returns the number of statements."""
+    with engine.begin() as conn:
+        for stmt in SCHEMA_UPGRADES:
+            conn.execute(text(stmt))
+    return len(SCHEMA_UPGRADES)
@@ -0,0 +1,259 @@
+# near-duplicate meal detection with MinHash signatures and LSH banding
+# "Overnight Oats with Berries" and "Berry Overnight Oats" share name tokens and ingredients, so they land in the same
+# LSH bucket and are mapped onto one canonical meal (recorded in meal_aliases) instead of becoming two meals rows
+# candidates are only merged when their ingredient sets nearly match and they agree on every protein / diet token,
+# so "Tofu Stir Fry" never merges onto "Chicken Stir Fry". band buckets are persisted in meal_signature_bands,
+# so checking a new meal at persist time is one indexed query instead of loading every meal
+
+import zlib
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
+
+import numpy as np #type: ignore
+from sqlalchemy import tuple_ #type: ignore
+from sqlalchemy.orm import Session #type: ignore
+from db import SessionLocal, Meal, MealAlias, MealIngredient, MealSignatureBand
+from retrieval_agent import tokenize, DIET_TERMS
+from canonical import normalize_name, singularize
+
+NUM_PERM = 64
+BANDS = 16              # 16 bands x 4 rows: pairs above ~0.5 Jaccard become candidates
+ROWS = NUM_PERM // BANDS
+THRESHOLD = 0.8         # exact Jaccard of the two ingredient sets a candidate pair must reach to be merged
+STOPWORDS = {"with", "and", "a", "an", "the", "of", "in", "on", "style", "easy", "simple", "homemade"}
+# tokens two meals must agree on to be merged (proteins and single-word terms a dietary tag excludes)
+DIET_TOKENS = {tok for terms in DIET_TERMS.values() for term in terms if len(term) == 1 for tok in term} | {
+    "tofu", "tempeh", "seitan", "vegan", "vegetarian", "meatless", "plant", "keto", "paleo",
+}
+
+_PRIME = (1 << 61) - 1
+_rng = np.random.RandomState(1) # fixed seed so signatures are comparable across runs
+_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+
+
+def features(name: str, ingredients: Iterable[str]) -> Set[str]:
+    """Name tokens and ingredient tokens, prefixed so the two never collide."""
+    feats = {"n:" + t for t in tokenize(name) if t not in STOPWORDS}
+    for ing in ingredients:
+        feats |= {"i:" + t for t in tokenize(ing)}
+    return feats
+
+
+def ingredient_set(ingredients: Iterable[str]) -> FrozenSet[str]:
+    # whole normalized ingredient names, "Cherry Tomatoes" and "cherry tomato" are the same element
+    return frozenset(filter(None, (singularize(normalize_name(i)) for i in ingredients)))
+
+
+def diet_tokens(feats: Set[str]) -> FrozenSet[str]:
+    return frozenset(f[2:] for f in feats) & DIET_TOKENS
+
+
+def signature(feats: Set[str]) -> np.ndarray:
+    # universal hashing of crc32 token hashes, minimum per permutation
+    if not feats:
+        return np.full(NUM_PERM, np.iinfo(np.uint64).max, dtype=np.uint64)
+    h = np.array([zlib.crc32(f.encode()) for f in feats], dtype=np.uint64)
+    return ((np.outer(h, _A) + _B) % _PRIME).min(axis=0)
+
+
+def band_keys(feats: Set[str]) -> List[tuple]:
+    """(band, bucket) per LSH band, bucket is a crc32 of the band's signature rows."""
+    sig = signature(feats)
+    return [(b, zlib.crc32(sig[b * ROWS:(b + 1) * ROWS].tobytes())) for b in range(BANDS)]
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / max(1, len(a | b))
+
+
+def similarity(feats_a: Set[str], ings_a: FrozenSet[str], feats_b: Set[str], ings_b: FrozenSet[str]) -> Optional[float]:
+    """
+    Ingredient-set Jaccard of two LSH candidates if they may be merged, otherwise None
+    (any protein / diet token in one but not the other, or Jaccard below THRESHOLD).
+    """
+    if diet_tokens(feats_a) != diet_tokens(feats_b):
+        return None
+    sim = jaccard(ings_a, ings_b)
+    return sim if sim >= THRESHOLD else None
+
+
+def index_meal(session: Session, meal_id, name: str, ingredients: Iterable[str]):
+    """Stores a meal's band buckets so find_duplicate can see it."""
+    session.add_all(
+        MealSignatureBand(meal_id=meal_id, band=band, bucket=bucket)
+        for band, bucket in band_keys(features(name, ingredients))
+    )
+
+
+def find_duplicate(session: Session, name: str, ingredients: Iterable[str]) -> Optional[Meal]:
+    """
+    The most similar stored meal a new meal may be merged onto, or None.
+    Candidates come from meal_signature_bands (meals indexed at persist time or by `cli.py dedup`).
+    """
+    ingredients = list(ingredients)
+    feats, ings = features(name, ingredients), ingredient_set(ingredients)
+    ids = [
+        meal_id for meal_id, in session.query(MealSignatureBand.meal_id)
+        .filter(tuple_(MealSignatureBand.band, MealSignatureBand.bucket).in_(band_keys(feats)))
+        .distinct()
+    ]
+    if not ids:
+        return None
+    cand_ings = defaultdict(list)
+    for meal_id, ing_name in session.query(MealIngredient.meal_id, MealIngredient.name).filter(MealIngredient.meal_id.in_(ids)):
+        cand_ings[meal_id].append(ing_name)
+    best, best_sim = None, -1.0
+    for meal in session.query(Meal).filter(Meal.id.in_(ids)):
+        sim = similarity(feats, ings, features(meal.meal_name, cand_ings[meal.id]), ingredient_set(cand_ings[meal.id]))
+        if sim is not None and sim > best_sim:
+            best, best_sim = meal, sim
+    return best
+
+
+def resolve_meal_names(session: Session, names: Iterable[str]) -> Dict[str, Meal]:
+    """
+    Maps plan meal names (lowercased) to meals rows, following meal_aliases for names that were
+    merged onto a canonical meal.
+    """
+    names = set(names)
+    found = {m.meal_name.lower(): m for m in session.query(Meal).filter(Meal.meal_name.in_(names)).all()}
+    missing = [n for n in names if n.lower() not in found]
+    if missing:
+        rows = (
+            session.query(MealAlias.alias, Meal)
+            .join(Meal, Meal.id == MealAlias.meal_id)
+            .filter(MealAlias.alias.in_(missing))
+            .all()
+        )
+        for alias, meal in rows:
+            found[alias.lower()] = meal
+    return found
+
+
+class MealDeduper:
+    """In-memory LSH index over the whole meals table, used by the offline rebuild()."""
+    def __init__(self):
+        self.ids: list = []
+        self.names: List[str] = []
+        self.feats: List[Set[str]] = []
+        self.ings: List[FrozenSet[str]] = []
+        self.keys: List[List[tuple]] = []
+        self.buckets: Dict[tuple, List[int]] = defaultdict(list)
+
+    @classmethod
+    def build(cls) -> "MealDeduper":
+        """Indexes every meal in the database (names and ingredient names only)."""
+        ingredients = defaultdict(list)
+        with SessionLocal() as session:
+            for meal_id, name in session.query(MealIngredient.meal_id, MealIngredient.name).yield_per(20000):
+                ingredients[meal_id].append(name)
+            meals = session.query(Meal.id, Meal.meal_name).yield_per(5000).all()
+        index = cls()
+        for meal_id, name in meals:
+            index.add(meal_id, name, ingredients.get(meal_id, []))
+        print(f"Indexed {len(index.ids)} meals for near-duplicate detection")
+        return index
+
+    def add(self, meal_id, name: str, ingredients: Iterable[str]) -> int:
+        ingredients = list(ingredients)
+        idx = len(self.ids)
+        feats = features(name, ingredients)
+        keys = band_keys(feats)
+        self.ids.append(meal_id)
+        self.names.append(name)
+        self.feats.append(feats)
+        self.ings.append(ingredient_set(ingredients))
+        self.keys.append(keys)
+        for key in keys:
+            self.buckets[key].append(idx)
+        return idx
+
+    def find(self, name: str, ingredients: Iterable[str]):
+        """Returns the id of the most similar indexed meal that may be merged, or None."""
+        ingredients = list(ingredients)
+        feats, ings = features(name, ingredients), ingredient_set(ingredients)
+        candidates = set()
+        for key in band_keys(feats):
+            candidates.update(self.buckets.get(key, ()))
+        best, best_sim = None, -1.0
+        for idx in candidates:
+            sim = similarity(feats, ings, self.feats[idx], self.ings[idx])
+            if sim is not None and sim > best_sim:
+                best, best_sim = self.ids[idx], sim
+        return best
+
+    def clusters(self) -> List[List[int]]:
+        """
+        Groups of near-duplicate meal indices (union-find over verified candidate pairs).
+        Joining is transitive but similarity is not: a chain A~B~C can put A and C in one group although
+        they are not near-duplicates of each other, so callers must re-check members against their pick.
+        """
+        parent = list(range(len(self.ids)))
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for members in self.buckets.values():
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    ra, rb = root(a), root(b)
+                    if ra != rb and similarity(self.feats[a], self.ings[a], self.feats[b], self.ings[b]) is not None:
+                        parent[rb] = ra
+
+        groups = defaultdict(list)
+        for i in range(len(self.ids)):
+            groups[root(i)].append(i)
+        return [g for g in groups.values() if len(g) > 1]
+
+
+def rebuild(apply: bool = False) -> dict:
+    """
+    Offline pass over the whole meals table: clusters near-duplicates and, with apply=True, keeps one canonical
+    meal per cluster (already costed first, then most ingredients), records the members that are near-duplicates
+    of it in meal_aliases and deletes them (their meal_ingredients cascade). Members only reached through a chain
+    are left alone. Returns the row and nutrition work reduction.
+    Meals missing from meal_signature_bands (stored before it existed) are indexed either way.
+    """
+    index = MealDeduper.build()
+    groups = index.clusters()
+    removed = set()
+    position = {meal_id: i for i, meal_id in enumerate(index.ids)}
+    with SessionLocal() as session:
+        stats = {"meals": len(index.ids), "clusters": len(groups), "meals_removed": 0,
+                 "ingredient_rows_removed": 0, "uncosted_ingredients_avoided": 0, "meals_indexed": 0}
+        for group in groups:
+            meals = session.query(Meal).filter(Meal.id.in_([index.ids[i] for i in group])).all()
+            ings = defaultdict(list)
+            for ing in session.query(MealIngredient).filter(MealIngredient.meal_id.in_([m.id for m in meals])):
+                ings[ing.meal_id].append(ing)
+            meals.sort(key=lambda m: (m.calories_total is None, -len(ings[m.id]), str(m.id)))
+            canonical = meals[0]
+            c = position[canonical.id]
+            for dup in meals[1:]:
+                d = position[dup.id]
+                if similarity(index.feats[c], index.ings[c], index.feats[d], index.ings[d]) is None:
+                    continue
+                stats["meals_removed"] += 1
+                stats["ingredient_rows_removed"] += len(ings[dup.id])
+                stats["uncosted_ingredients_avoided"] += sum(1 for i in ings[dup.id] if i.cals_per_100g is None)
+                if apply:
+                    removed.add(dup.id)
+                    # aliases pointing at the duplicate move to the canonical meal
+                    session.query(MealAlias).filter_by(meal_id=dup.id).update({MealAlias.meal_id: canonical.id})
+                    session.merge(MealAlias(alias=dup.meal_name, meal_id=canonical.id))
+                    session.delete(dup)
+            if apply:
+                session.commit()
+
+        indexed = {meal_id for meal_id, in session.query(MealSignatureBand.meal_id).distinct()}
+        for i, meal_id in enumerate(index.ids):
+            if meal_id in indexed or meal_id in removed:
+                continue
+            session.add_all(MealSignatureBand(meal_id=meal_id, band=band, bucket=bucket) for band, bucket in index.keys[i])
+            stats["meals_indexed"] += 1
+        session.commit()
+    return stats
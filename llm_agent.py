@@ -7,40 +7,149 @@ from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 from models import WeeklyPlan
 from agent import Agent
 from json_utils import extract_best_mealplan
+from typing import Optional
 import os
+import time
 #import re
 
 
+DRIVE_CACHE_PATH = '/content/drive/MyDrive/models'
+# previously accepted plans (one compact JSON per line), used as the reference output with reference_prompt
+DRAFT_HISTORY_PATH = os.getenv("DRAFT_HISTORY_PATH", "draft_history.jsonl")
+# generation budget per requested meal when only some slots are generated (a full week uses 4096)
+TOKENS_PER_MEAL = 192
+
+# model loaders, one per inference backend. each returns a model with a HuggingFace style generate()
+
+def load_bnb4(model_name: str, device: str):
+    # 4-bit NF4 bitsandbytes quantization, needs CUDA
+    return AutoModelForCausalLM.from_pretrained(
+        model_name,
+        trust_remote_code=True,
+        cache_dir=DRIVE_CACHE_PATH,
+        quantization_config=BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype="float16",
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True
+        )
+    ).to(device)
+
+def load_cpu_int8(model_name: str, device: str):
+    # fp32 weights with int8 dynamic quantization of every Linear layer, runs on plain CPUs
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        trust_remote_code=True,
+        cache_dir=DRIVE_CACHE_PATH,
+        torch_dtype=torch.float32,
+        low_cpu_mem_usage=True,
+    )
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_onnx(model_name: str, device: str):
+    # exports the model to an ONNX Runtime graph once, saved under DRIVE_CACHE_PATH/onnx and loaded from there afterwards
+    from optimum.onnxruntime import ORTModelForCausalLM #type: ignore
+    import onnxruntime as ort #type: ignore
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = torch.get_num_threads()
+    provider = "CUDAExecutionProvider" if device.startswith("cuda") else "CPUExecutionProvider"
+    export_dir = os.path.join(DRIVE_CACHE_PATH, "onnx", model_name.replace("/", "--"))
+    if not os.path.isdir(export_dir):
+        model = ORTModelForCausalLM.from_pretrained(model_name, export=True, cache_dir=DRIVE_CACHE_PATH)
+        # saved next to the final path and renamed, so an interrupted export is never loaded
+        partial = export_dir + ".partial"
+        model.save_pretrained(partial)
+        os.replace(partial, export_dir)
+    return ORTModelForCausalLM.from_pretrained(export_dir, export=False, session_options=options, provider=provider)
+
+BACKENDS = {
+    "bnb4": load_bnb4,
+    "cpu-int8": load_cpu_int8,
+    "onnx": load_onnx,
+}
+
+def resolve_backend(backend: str, device: str) -> str:
+    # "auto" keeps 4-bit bitsandbytes on GPUs and uses int8 dynamic quantization on CPU-only nodes
+    if backend == "auto":
+        return "bnb4" if device.startswith("cuda") else "cpu-int8"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}. Choose from auto, {', '.join(BACKENDS)}")
+    return backend
+
+
 class LLMMealPlanAgent(Agent):
-    #iniitalizes the agent by loading a tokenizer and model from HuggingFace
-    def __init__(self, model_name: str, device: str = "cpu"):
-        drive_cache_path = '/content/drive/MyDrive/models'
-        os.environ["TRANSFORMERS_CACHE"] = drive_cache_path
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=drive_cache_path)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name, 
-            trust_remote_code=True,
-            cache_dir=drive_cache_path,
-            quantization_config=BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_compute_dtype="float16",
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_use_double_quant=True
-            )
-        ).to(device)
+    #iniitalizes the agent, the tokenizer and model are loaded from HuggingFace with the chosen backend on first use
+    #so a plan fully composed by RetrievalPlanAgent never pays for loading the LLM
+    #draft enables speculative decoding: "prompt-lookup" for the n-gram drafter, or the name of a small draft model
+    #draft_tokens is how many tokens the drafter proposes per verification step
+    #reference_prompt adds the last accepted plan to the prompt as a format reference. it gives prompt lookup n-grams
+    #to copy, but changes the prompt (and so the output) and lengthens prefill, so it is a separate opt-in
+    def __init__(self, model_name: str, device: str = "cpu", backend: str = "auto", threads: Optional[int] = None,
+                 draft: Optional[str] = None, draft_tokens: int = 10, reference_prompt: bool = False):
+        self.model_name = model_name
         self.device = device
+        self.backend = resolve_backend(backend, device)
+        self.threads = threads
+        self.draft = draft
+        self.draft_tokens = draft_tokens
+        self.reference_prompt = reference_prompt
+        self.tokenizer = None
+        self.model = None
+        self.draft_model = None
+        self.draft_tokenizer = None
 
-    #retreives dietary tags from context, generates a prompt, and uses the model to generate a weekly meal plan
-    def run(self, context):
-        dietary = context.get("dietary_tags", "")
+    def load(self):
+        if self.model is not None:
+            return
+        os.environ["TRANSFORMERS_CACHE"] = DRIVE_CACHE_PATH
+        if self.threads:
+            torch.set_num_threads(self.threads) # also used for the ONNX Runtime session
+        device, draft, draft_tokens = self.device, self.draft, self.draft_tokens
+        print(f"Loading {self.model_name} with backend {self.backend} on {device} ({torch.get_num_threads()} threads)")
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, cache_dir=DRIVE_CACHE_PATH)
+        self.model = BACKENDS[self.backend](self.model_name, device)
+
+        if draft and draft != "prompt-lookup":
+            print(f"Loading draft model {draft}")
+            self.draft_tokenizer = AutoTokenizer.from_pretrained(draft, cache_dir=DRIVE_CACHE_PATH)
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft,
+                cache_dir=DRIVE_CACHE_PATH,
+                torch_dtype=torch.float16 if device.startswith("cuda") else torch.float32,
+            ).to(device)
+            # constant draft length per verification step
+            self.draft_model.generation_config.num_assistant_tokens = draft_tokens
+            self.draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+
+    @staticmethod
+    def build_prompt(dietary: str, example: Optional[str] = None, slots: Optional[list] = None) -> str:
         #creats detailed prompt, ensures it matches the WeeklyPlan schema
-        prompt = f"""
+        #an example plan (reference_prompt) gives the prompt-lookup drafter n-grams of the repetitive JSON structure to copy
+        #slots ([day, slot] pairs) asks for just those meals instead of the whole week
+        reference = f"""Reference output (format only, choose different meals):
+        {example}
+        """ if example else ""
+        if slots:
+            by_day = {}
+            for day, slot in slots:
+                by_day.setdefault(day, []).append(slot)
+            wanted = "; ".join(f'{day}: {", ".join(day_slots)}' for day, day_slots in by_day.items())
+            task = f"Generate only these meals of a 7-day meal plan in JSON: {wanted}."
+            keys_rule = f"Output exactly one JSON object whose keys are only the days listed above ({', '.join(by_day)})."
+            meals_rule = "Under each day include only the meals listed for that day."
+        else:
+            task = "Generate a complete 7-day meal plan in JSON."
+            keys_rule = 'Output exactly one JSON object with keys "Monday" through to "Sunday".'
+            meals_rule = 'Under each day include exactly three meals: "breakfast", "lunch", "dinner".'
+        return f"""
         [INST]
-        Generate a complete 7-day meal plan in JSON.
+        {task}
 
         STRICT RULES:
-        1. Output exactly one JSON object with keys "Monday" through to "Sunday".
-        2. Under each day include exactly three meals: "breakfast", "lunch", "dinner".
+        1. {keys_rule}
+        2. {meals_rule}
         3. Each meal is an object: {{"name": "string", "ingredients": [{{"name": "string", "quantity": number, "unit": "string"}}]}}
         4. Use only the units “g” (grams) for solids and “ml” (milliliters) for liquids.
         5. If the original recipe calls for “cup”, “tablespoon”, “piece”, etc., convert that to grams/ml using standard averages:
@@ -51,9 +160,112 @@ class LLMMealPlanAgent(Agent):
         - …etc.  
         6. Output ONLY valid JSON (no markdown, no comments, no extra fields, no explanations or extra text).
         7. Do not use ellipses (…) or text placeholders like "//..."
-        Dietary tags: {dietary}
+        {reference}Dietary tags: {dietary}
         [/INST]
         """
+
+    def load_draft_example(self) -> Optional[str]:
+        # most recent accepted plan, only with reference_prompt
+        if not self.reference_prompt or not os.path.exists(DRAFT_HISTORY_PATH):
+            return None
+        with open(DRAFT_HISTORY_PATH, "r") as f:
+            lines = [l.strip() for l in f if l.strip()]
+        return lines[-1] if lines else None
+
+    def save_draft_example(self, plan: WeeklyPlan):
+        if not self.reference_prompt:
+            return
+        with open(DRAFT_HISTORY_PATH, "a") as f:
+            f.write(plan.json() + "\n")
+
+    def generate(self, inputs: dict, num_candidates: int, max_new_tokens: int = 4096) -> tuple[list, dict]:
+        """
+        Samples num_candidates sequences and returns (sequences, decode stats).
+        With a drafter, candidates are generated one at a time (assisted generation needs batch size 1).
+        Forward hooks count main-model verification steps, each yields one main-model token plus the accepted draft
+        tokens, and draft-model forwards, each proposes one token. Prompt lookup proposes up to draft_tokens per step
+        (fewer, or none, when no n-gram matches) without a model, so its rate is only a lower bound.
+        """
+        sampling = dict(max_new_tokens=max_new_tokens, do_sample=True, temperature=0.7, top_p=0.9)
+        prompt_len = inputs["input_ids"].shape[1]
+        steps = [0]
+        proposed = [0]
+        hooks = []
+        if self.draft and hasattr(self.model, "register_forward_hook"):
+            hooks.append(self.model.register_forward_hook(lambda *_: steps.__setitem__(0, steps[0] + 1)))
+        if self.draft_model is not None:
+            hooks.append(self.draft_model.register_forward_hook(lambda *_: proposed.__setitem__(0, proposed[0] + 1)))
+
+        start = time.perf_counter()
+        try:
+            if not self.draft:
+                outputs = list(self.model.generate(**inputs, num_return_sequences=num_candidates, **sampling))
+            else:
+                if self.draft == "prompt-lookup":
+                    draft_args = {"prompt_lookup_num_tokens": self.draft_tokens}
+                else:
+                    draft_args = {"assistant_model": self.draft_model}
+                    if self.draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                        # universal assisted decoding, re-tokenizes between the two vocabularies
+                        draft_args.update(tokenizer=self.tokenizer, assistant_tokenizer=self.draft_tokenizer)
+                outputs = [
+                    self.model.generate(**inputs, **draft_args, **sampling)[0]
+                    for _ in range(num_candidates)
+                ]
+        finally:
+            for hook in hooks:
+                hook.remove()
+        seconds = time.perf_counter() - start
+
+        new_tokens = sum(int(o.shape[0]) - prompt_len for o in outputs)
+        stats = {"draft": self.draft, "new_tokens": new_tokens, "seconds": round(seconds, 2),
+                 "tokens_per_s": round(new_tokens / max(seconds, 1e-9), 2)}
+        if self.draft and steps[0]:
+            # every verification step yields the accepted draft tokens plus one token from the main model
+            accepted = max(0, new_tokens - steps[0])
+            stats.update(verify_steps=steps[0], tokens_per_step=round(new_tokens / steps[0], 2), accepted_tokens=accepted)
+            if proposed[0]:
+                stats.update(proposed_tokens=proposed[0], acceptance_rate=round(min(1.0, accepted / proposed[0]), 3))
+            else:
+                # prompt lookup: assumes draft_tokens proposed every step, the true rate is at least this
+                stats.update(acceptance_rate_lower_bound=round(min(1.0, accepted / (steps[0] * self.draft_tokens)), 3))
+        print(f"Decode stats: {stats}")
+        return outputs, stats
+
+    #retreives dietary tags from context, generates a prompt, and uses the model to generate a weekly meal plan
+    #slots listed in context["unfilled_slots"] are filled into the partial plan RetrievalPlanAgent left in the context
+    @staticmethod
+    def merge_partial(partial: WeeklyPlan, generated: WeeklyPlan, unfilled: list) -> WeeklyPlan:
+        days = {day: dict(meals) for day, meals in partial.days.items()}
+        for day, slot in unfilled:
+            meal = generated.days.get(day, {}).get(slot)
+            if meal is not None:
+                days.setdefault(day, {})[slot] = meal
+        return WeeklyPlan(days=days)
+
+    def run(self, context):
+        partial = None
+        unfilled = context.get("unfilled_slots")
+        if unfilled is not None and "weekly_plan" in context:
+            if not unfilled:
+                print("Plan fully composed from stored meals, skipping generation")
+                return context
+            partial = context["weekly_plan"]
+            print(f"Generating {len(unfilled)} slots not filled from stored meals")
+
+        self.load()
+        dietary = context.get("dietary_tags", "")
+        prompt = self.build_prompt(dietary, self.load_draft_example(), slots=unfilled if partial is not None else None)
+        # a full plan scores 2 per day + 1 per meal (35), a partial one only needs the requested days and meals
+        if partial is not None:
+            min_score = 2 * len({day for day, _ in unfilled}) + len(unfilled)
+            max_new_tokens = min(4096, TOKENS_PER_MEAL * len(unfilled) + 64)
+        else:
+            min_score, max_new_tokens = 35, 4096
+        # optional per-day nutrition targets, when given K candidates are generated per attempt and the closest is kept
+        targets = context.get("nutrition_targets") or None
+        num_candidates = max(1, int(context.get("num_candidates", 1)))
+
         #start attempt loop and prompt, current 5 retries
         last_error = None
         for attempt in range(1, 6):
@@ -61,34 +273,58 @@ class LLMMealPlanAgent(Agent):
             inputs = self.tokenizer(prompt, return_tensors="pt")
             inputs = {k: v.to(self.device) for k, v in inputs.items()}
             # generates output, encrouages to be creative with sampling
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=4096,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9
-            )
-            
-            #output decoded to text
-            text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            print(f"[Attempt {attempt}] Generated LLM text:\n{text}\nEND OF LLM TEXT")
-            
-            # Extract the JSON
-            try:
-                score, json_dict = extract_best_mealplan(text)
-                print(f"Extracted JSON string type: {type(json_dict)}") #print the object type for debugging
-            except Exception as e:
-                raise RuntimeError(f"Failed to parse LLM output: {e}\n{text}")
-            
-            # accept only if score is high enough, otherwise retry
-            if score >= 35:
-                print(f"Plan accepted (score={score}) on attempt {attempt}")
-                plan = WeeklyPlan.parse_obj(json_dict) # parses JSON into WeeklyPlan model object
+            outputs, stats = self.generate(inputs, num_candidates, max_new_tokens)
+            context.setdefault("decode_stats", []).append(stats)
+
+            # parse every candidate, keeping the structurally complete ones
+            candidates = []
+            parse_errors = []
+            for i, output in enumerate(outputs):
+                #only the generated part is decoded, so JSON in the prompt (e.g. a draft example) is never picked up
+                text = self.tokenizer.decode(output[inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+                print(f"[Attempt {attempt}, candidate {i + 1}] Generated LLM text:\n{text}\nEND OF LLM TEXT")
+
+                # Extract the JSON
+                try:
+                    score, json_dict = extract_best_mealplan(text)
+                    print(f"Extracted JSON string type: {type(json_dict)}") #print the object type for debugging
+                except Exception as e:
+                    parse_errors.append(f"Failed to parse LLM output: {e}\n{text}")
+                    continue
+
+                # accept only if score is high enough
+                if score < min_score:
+                    last_error = f"Score {score} below threshold {min_score}"
+                    continue
+                candidate = WeeklyPlan.parse_obj(json_dict) # parses JSON into WeeklyPlan model object
+                missing = [s for s in unfilled or [] if s[1] not in candidate.days.get(s[0], {})] if partial is not None else []
+                if missing:
+                    last_error = f"Generated meals missing requested slots {missing}"
+                    continue
+                candidates.append(candidate)
+
+            if not candidates and len(parse_errors) == len(outputs):
+                raise RuntimeError(parse_errors[-1])
+
+            if candidates:
+                if partial is not None:
+                    candidates = [self.merge_partial(partial, c, unfilled) for c in candidates]
+                    context["unfilled_slots"] = []
+                plan = candidates[0]
+                if targets:
+                    # rank on estimated nutrition straight after parsing, before anything is persisted
+                    from nutrition_estimator import NutritionEstimator
+                    estimator = NutritionEstimator.shared()
+                    scored = sorted(((estimator.score(c, targets), i) for i, c in enumerate(candidates)))
+                    best_distance, best_i = scored[0]
+                    plan = candidates[best_i]
+                    context["nutrition_distance"] = best_distance
+                    print(f"Candidate distances from targets: {[round(d, 3) for d, _ in scored]}")
+                print(f"Plan accepted ({len(candidates)}/{len(outputs)} candidates valid) on attempt {attempt}")
                 context["weekly_plan"] = plan
+                self.save_draft_example(plan)
                 return context
-            else:
-                last_error = f"Score {score} below threshold 35"
-        
+
         # all retries exhausted, raise error
         raise RuntimeError(f"Failed to generate valid meal plan after 5 attempts: {last_error}")
     
@@ -1,8 +1,9 @@
 # This file defines the core objects for the groecery bot application.
 #we need a class for our weekly meal plan, and each meal, recipe
 
+import re
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Union
 
 class Ingredient(BaseModel):
     name: str
@@ -15,4 +16,18 @@ class Meal(BaseModel):
 
 # days is a dictionary with keys as day names and vlaue as another dictionary with meal names as keys and Meal objects as values
 class WeeklyPlan(BaseModel):
-    days: Dict[str, Dict[str, Meal]]
\ No newline at end of file
+    days: Dict[str, Dict[str, Meal]]
+
+# dietary tags arrive as "vegan, keto" from the CLI or as a list, stored as a list of lowercase tags
+def parse_tags(tags: Union[str, List[str], None]) -> List[str]:
+    if not tags:
+        return []
+    if isinstance(tags, str):
+        tags = re.split(r"[,\s]+", tags)
+    return [t.strip().lower() for t in tags if t and t.strip()]
+
+# builds a model from already-validated data without re-running validation (pydantic v2 model_construct, v1 construct)
+def construct(model, **fields):
+    if hasattr(model, "model_construct"):
+        return model.model_construct(**fields)
+    return model.construct(**fields)
@@ -1,21 +1,31 @@
 import os
 import requests #type: ignore
 import re
-from sqlalchemy import text #type: ignore
+import numpy as np #type: ignore
+from sqlalchemy import text, tuple_ #type: ignore
 from sqlalchemy.orm import Session #type: ignore
 from db import SessionLocal, NutritionLookup, Meal, MealIngredient, ShoppingItem
-from typing import Optional
+from models import WeeklyPlan
+from compact_plan import CompactPlan, iter_meals
+from dedup import resolve_meal_names
+from canonical import Canonicalizer
+from collections import defaultdict
+from typing import Optional, Union
 
 USDA_API_KEY = os.getenv("USDA_API_KEY")
 
+# fixed order of the per-100g nutrient vector stored in nutrition_lookup.nutrients
+NUTRIENTS = ("energy_kcal", "protein_g", "fat_g", "carbs_g", "fibre_g")
+# USDA nutrient numbers for everything after energy (energy uses the first "energy" nutrient, like calories_per_100g)
+USDA_NUTRIENT_NUMBERS = {"protein_g": "203", "fat_g": "204", "carbs_g": "205", "fibre_g": "291"}
+
 class NutritionAgent:
     def run(self, ctx: dict) -> dict:
         print("Running NutritionAgent...")
         plan_id = ctx["db_plan_id"]
 
-        if not USDA_API_KEY: #confirm API key is set
-            raise RuntimeError("USDA_API_KEY environment variable is not set. Please set it before running the application.")
-        
+        self.require_api_key()
+
         with SessionLocal() as session:
             # Ensure nutrition_lookup is populated from shopping_items
             items = session.query(ShoppingItem).filter_by(plan_id=plan_id).all()
@@ -26,17 +36,9 @@ class NutritionAgent:
             print("Collecting meals for plan...")
             # Collect all the meal names from the weekly plan
             weekly_plan = ctx["weekly_plan"]
-            meal_names = [
-                meal_obj.name
-                for meals_by_day in weekly_plan.days.values()
-                for meal_obj in meals_by_day.values()
-            ]
-            # load only those meals from Postgres
-            meals = (
-                session.query(Meal)
-                .filter(Meal.meal_name.in_(meal_names))
-                .all()
-            )
+            meal_names = [meal_obj.name for _, _, meal_obj in iter_meals(weekly_plan)]
+            # load only those meals from Postgres (names merged onto a canonical meal resolve through meal_aliases)
+            meals = list({m.id: m for m in resolve_meal_names(session, meal_names).values()}.values())
             print(f"Found {len(meals)} meals in DB for plan ID {plan_id}.")
 
             # Process each meal only if calories_total is NULL
@@ -46,68 +48,222 @@ class NutritionAgent:
                 if meal.calories_total is not None:
                     print(f"Meal '{meal.meal_name}' total calories: {meal.calories_total:.1f}")
                     continue  # already calculated
+                self.cost_meal(session, meal)
 
-                total_cals = 0.0
-                # load ingredients for this meal
-                ings = session.query(MealIngredient) \
-                             .filter_by(meal_id=meal.id) \
-                             .all()
-
-                # for each ingredient, if it doesnt have a calper100 then query the lookup
-                #if it doesnt exist in the lookup call the api
-                for ing in ings: 
-                    #get or fetch per 100g cals and fdc_id
-                    if ing.cals_per_100g is None:
-                        rec = session.get(NutritionLookup, self.normalize(ing.name))
-                        if rec:
-                            ing.cals_per_100g = rec.calories_per_100g
-                            ing.fdc_id       = rec.usda_fdc_id
-                        else:
-                            # fallback: query USDA live
-                            c100, fdc = self.get_calories_for_item(session, ing.name)
-                            ing.cals_per_100g = c100
-                            ing.fdc_id       = fdc
-                        session.add(ing)
-                    
-                    #if still missing (meaning no match), skip
-                    if ing.cals_per_100g is None:
-                        print(f"[WARN] No calorie data for '{ing.name}', skipping.")
-                        continue
-                    
-                    print(f"Ingredient '{ing.name}': {ing.quantity} {ing.unit} at {ing.cals_per_100g} kcal/100g")
-                    # convert quantity+unit ➔ grams
-                    grams = self.convert_to_grams(ing.quantity, ing.unit, ing.fdc_id)
-                    # compute total cals for this ingredient
-                    ing.cals_total = (grams / 100.0) * ing.cals_per_100g
-                    total_cals    += ing.cals_total
-
-
-                    # lookup per-100g cals from meal_ingredient if cached
-                    #c100 = ing.cals_per_100g
-                    #fdc  = ing.fdc_id
-
-                    # else fetch from nutrition_lookup
-                    #if c100 is None:
-                    #    rec = session.get(NutritionLookup, self.normalize(ing.name))
-                    #    if rec:
-                    #        c100 = rec.calories_per_100g
-                    #        fdc  = rec.usda_fdc_id
-
-                        # update MealIngredient row for future
-                        #ing.cals_per_100g = c100
-                        #ing.fdc_id       = fdc
-                        #session.add(ing)
-
-                # store meal total
-                meal.calories_total = total_cals
-                session.add(meal)
-                print(f"Meal '{meal.meal_name}' total calories: {total_cals:.1f}")
+            session.commit()
 
+            # full macro breakdown for the plan from the stored nutrient vectors
+            ctx["macros"] = self.macro_report(session, weekly_plan)
             session.commit()
 
         ctx["calories_done"] = True
         return ctx
 
+    def cost_meal(self, session: Session, meal: Meal) -> float:
+        """
+        Computes and stores calories for every ingredient of a meal and the meal total.
+        Ingredients remember which nutrition_lookup row/version they were costed from, so later
+        corrections to that row can be detected by recompute().
+        """
+        total_cals = 0.0
+        # load ingredients for this meal
+        ings = session.query(MealIngredient) \
+                     .filter_by(meal_id=meal.id) \
+                     .all()
+
+        # for each ingredient, if it doesnt have a calper100 then query the lookup
+        #if it doesnt exist in the lookup call the api
+        for ing in ings:
+            # costed before lookup rows were tracked, link it (or reset it if the lookup row has changed since)
+            if ing.cals_per_100g is not None and ing.lookup_name is None:
+                self.link_lookup(session, ing)
+            #get or fetch per 100g cals and fdc_id
+            if ing.cals_per_100g is None:
+                norm = self.normalize(ing.name)
+                rec = session.get(NutritionLookup, norm)
+                if not rec:
+                    # fallback: query USDA live, this inserts into nutrition_lookup when a match is found
+                    self.get_calories_for_item(session, ing.name)
+                    rec = session.get(NutritionLookup, norm)
+                if rec:
+                    ing.cals_per_100g  = rec.calories_per_100g
+                    ing.fdc_id         = rec.usda_fdc_id
+                    ing.lookup_name    = rec.name
+                    ing.lookup_version = rec.version
+                session.add(ing)
+
+            #if still missing (meaning no match), skip
+            if ing.cals_per_100g is None:
+                print(f"[WARN] No calorie data for '{ing.name}', skipping.")
+                continue
+
+            print(f"Ingredient '{ing.name}': {ing.quantity} {ing.unit} at {ing.cals_per_100g} kcal/100g")
+            # convert quantity+unit ➔ grams
+            grams = self.convert_to_grams(ing.quantity, ing.unit, ing.fdc_id)
+            ing.grams = grams # kept for macro_report
+            # compute total cals for this ingredient
+            ing.cals_total = (grams / 100.0) * ing.cals_per_100g
+            total_cals    += ing.cals_total
+
+        # store meal total
+        meal.calories_total = total_cals
+        session.add(meal)
+        print(f"Meal '{meal.meal_name}' total calories: {total_cals:.1f}")
+        return total_cals
+
+    def link_lookup(self, session: Session, ing: MealIngredient) -> Optional[NutritionLookup]:
+        """
+        Sets lookup_name / lookup_version on an ingredient costed before they existed.
+        If its nutrition_lookup row no longer has the calories it was costed with, the costing is reset and
+        the meal marked dirty instead, so the next cost_meal uses the current row. Returns the linked row or None.
+        """
+        rec = session.get(NutritionLookup, self.normalize(ing.name))
+        if rec is None:
+            return None
+        if rec.calories_per_100g != ing.cals_per_100g:
+            ing.cals_per_100g = ing.fdc_id = ing.cals_total = ing.grams = None
+            meal = session.get(Meal, ing.meal_id)
+            if meal is not None:
+                meal.calories_total = None
+            session.add(ing)
+            return None
+        ing.lookup_name = rec.name
+        ing.lookup_version = rec.version
+        session.add(ing)
+        return rec
+
+    def link_legacy(self, session: Session, batch_size: int) -> int:
+        # keyset pagination over costed ingredients with no lookup_name, committing after each batch
+        linked = 0
+        last = None
+        while True:
+            q = session.query(MealIngredient).filter(
+                MealIngredient.lookup_name.is_(None), MealIngredient.cals_per_100g.isnot(None)
+            )
+            if last is not None:
+                q = q.filter(tuple_(MealIngredient.meal_id, MealIngredient.name) > last)
+            ings = q.order_by(MealIngredient.meal_id, MealIngredient.name).limit(batch_size).all()
+            if not ings:
+                return linked
+            for ing in ings:
+                linked += self.link_lookup(session, ing) is not None
+            session.commit()
+            last = (ings[-1].meal_id, ings[-1].name)
+
+    def rekey_lookup(self, session: Session) -> int:
+        """
+        Moves nutrition_lookup rows stored under pre-canonical keys ("scallions") to their canonical name
+        ("green onion"), repointing meal_ingredients.lookup_name. When a row already exists under the canonical
+        name the old one is dropped, ingredients costed from it at other calories are left stale for recompute().
+        Rows already keyed canonically are untouched, so this is a no-op after the first run. Returns rows moved.
+        """
+        canonicalizer = Canonicalizer.shared()
+        moved = 0
+        for (name,) in session.query(NutritionLookup.name).all():
+            key = canonicalizer.canonical_name(name)
+            if not key or key == name.lower():
+                continue
+            params = {"old": name, "new": key}
+            target = session.execute(
+                text("SELECT calories_per_100g, version FROM nutrition_lookup WHERE name = :new"), params
+            ).first()
+            if target is None:
+                session.execute(text("UPDATE nutrition_lookup SET name = :new WHERE name = :old"), params)
+                session.execute(text("UPDATE meal_ingredients SET lookup_name = :new WHERE lookup_name = :old"), params)
+            else:
+                # version 0 is below every row version, so recompute() re-costs these
+                session.execute(
+                    text(
+                        "UPDATE meal_ingredients SET lookup_name = :new, "
+                        "lookup_version = CASE WHEN cals_per_100g = :cals THEN :version ELSE 0 END "
+                        "WHERE lookup_name = :old"
+                    ),
+                    {**params, "cals": target.calories_per_100g, "version": target.version},
+                )
+                session.execute(text("DELETE FROM nutrition_lookup WHERE name = :old"), params)
+            moved += 1
+        session.commit()
+        return moved
+
+    def recompute(self, batch_size: int = 500, full: bool = False) -> dict:
+        """
+        Incrementally re-costs only what changed since the last run:
+        1. ingredients costed from a nutrition_lookup row whose version has since been bumped are reset
+        2. their meals are marked dirty (calories_total = NULL), alongside meals PersistenceAgent changed
+        3. dirty meals are costed in keyset-paginated batches, committing after each batch
+        With full=True every meal is marked dirty first.
+        Lookup rows keyed before canonical ingredient names are re-keyed first (see rekey_lookup), then
+        ingredients costed before lookup rows were tracked are linked to theirs (see link_lookup).
+        """
+        self.require_api_key()
+        with SessionLocal() as session:
+            rekeyed = self.rekey_lookup(session)
+            print(f"{rekeyed} nutrition_lookup rows moved to their canonical ingredient names.")
+            linked = self.link_legacy(session, batch_size)
+            print(f"{linked} previously costed ingredients linked to their nutrition_lookup rows.")
+            if full:
+                session.execute(text("UPDATE meals SET calories_total = NULL"))
+
+            # reset stale ingredient costings and mark their meals dirty in one statement
+            stale_meal_ids = session.execute(
+                text(
+                    "WITH stale AS ("
+                    "  UPDATE meal_ingredients mi "
+                    "  SET cals_per_100g = NULL, fdc_id = NULL, cals_total = NULL, grams = NULL, lookup_version = NULL "
+                    "  FROM nutrition_lookup nl "
+                    "  WHERE mi.lookup_name = nl.name AND mi.lookup_version < nl.version "
+                    "  RETURNING mi.meal_id"
+                    ") "
+                    "UPDATE meals SET calories_total = NULL "
+                    "WHERE id IN (SELECT meal_id FROM stale) "
+                    "RETURNING id"
+                )
+            ).scalars().all()
+            session.commit()
+            print(f"{len(stale_meal_ids)} meals affected by nutrition_lookup corrections.")
+
+            # keyset pagination over the dirty meals (uses the partial ix_meals_uncosted index)
+            recomputed = 0
+            last_id = None
+            while True:
+                q = session.query(Meal).filter(Meal.calories_total.is_(None))
+                if last_id is not None:
+                    q = q.filter(Meal.id > last_id)
+                meals = q.order_by(Meal.id).limit(batch_size).all()
+                if not meals:
+                    break
+                for meal in meals:
+                    self.cost_meal(session, meal)
+                session.commit()
+                recomputed += len(meals)
+                last_id = meals[-1].id
+
+        return {"lookup_rekeyed": rekeyed, "legacy_linked": linked, "stale_meals": len(stale_meal_ids), "meals_recomputed": recomputed}
+
+    def correct_lookup(self, name: str, calories_per_100g: float, fdc_id: Optional[str] = None) -> int:
+        """
+        Corrects a nutrition_lookup row, the version trigger marks it changed for the next recompute().
+        A new fdc_id drops the stored nutrient vector so it is refetched for that food. Returns the new version.
+        """
+        with SessionLocal() as session:
+            rec = session.get(NutritionLookup, self.normalize(name))
+            if rec is None:
+                raise ValueError(f"No nutrition_lookup row for '{name}'")
+            rec.calories_per_100g = calories_per_100g
+            if fdc_id is not None and fdc_id != rec.usda_fdc_id:
+                rec.usda_fdc_id = fdc_id
+                rec.nutrients = None
+            elif rec.nutrients is not None:
+                rec.nutrients = [calories_per_100g] + list(rec.nutrients[1:])
+            session.commit()
+            session.refresh(rec)
+            return rec.version
+
+    @staticmethod
+    def require_api_key():
+        if not USDA_API_KEY: #confirm API key is set
+            raise RuntimeError("USDA_API_KEY environment variable is not set. Please set it before running the application.")
+
     #for making safe API calls with error handling and timeouts
     @staticmethod
     def safe_api_get(url: str, params: dict) -> Optional[dict]:
@@ -125,16 +281,8 @@ class NutritionAgent:
             return None
         
     def normalize(self, name: str) -> str:
-        # Remove patterns like "1.0 cup", "2 grams", etc.
-        name = re.sub(r"\b\d*\.?\d+\s*[a-zA-Z]+\b", "", name)
-        # remove descriptors that often cause noise — tweak as needed
-        remove_words = r"\b(organic|fresh|large|small|sliced|diced|chopped|minced|grilled|roasted|pan-fried|fried|baked|boiled|cooked)\b"
-        name = re.sub(remove_words, "", name)
-        # Remove any remaining non-letter characters and extra spaces
-        name = re.sub(r"[^a-zA-Z\s]", "", name)
-        # Collapse multiple spaces and strip
-        name = re.sub(r"\s+", " ", name).strip().lower()
-        return name
+        # canonical ingredient name (synonyms and plurals collapsed), also the nutrition_lookup key. read-only
+        return Canonicalizer.shared().canonical_name(name)
 
     def fetch_food_portions(self, fdc_id: str) -> list[dict]:
         """Fetches the 'foodPortions' array from the details endpoint."""
@@ -196,7 +344,7 @@ class NutritionAgent:
         """
         Return kcal value from first energy nutrient match, assumes it is based on per 100g.
         """
-        for n in food_obj.get("foodNutrients", []):
+        for n in self.flatten_nutrients(food_obj):
             if "energy" in n.get("nutrientName", "").lower():
                 value = n.get("value", 0)
                 unit = (n.get("unitName") or "").lower()
@@ -211,6 +359,120 @@ class NutritionAgent:
                     return 0.0
         return 0.0
 
+    @staticmethod
+    def flatten_nutrients(food_obj: dict) -> list[dict]:
+        """
+        The search endpoint returns flat foodNutrients ({"nutrientNumber", "nutrientName", "unitName", "value"}),
+        the details endpoint nests them ({"nutrient": {"number", "name", "unitName"}, "amount"}).
+        Returns them all in the flat search shape.
+        """
+        flat = []
+        for n in food_obj.get("foodNutrients", []):
+            if "nutrient" in n:
+                inner = n["nutrient"]
+                n = {
+                    "nutrientNumber": inner.get("number"),
+                    "nutrientName": inner.get("name", ""),
+                    "unitName": inner.get("unitName"),
+                    "value": n.get("amount", 0),
+                }
+            flat.append(n)
+        return flat
+
+    def extract_nutrient_vector_from_food(self, food_obj: dict) -> list[float]:
+        """
+        Return the per-100g nutrient vector in NUTRIENTS order, missing nutrients are 0.
+        """
+        by_number = {str(n.get("nutrientNumber")): n for n in self.flatten_nutrients(food_obj)}
+        vec = [self.extract_energy_kcal_from_food(food_obj)]
+        for key in NUTRIENTS[1:]:
+            n = by_number.get(USDA_NUTRIENT_NUMBERS[key])
+            try:
+                vec.append(float(n.get("value", 0)) if n else 0.0)
+            except Exception:
+                vec.append(0.0)
+        return vec
+
+    def nutrient_vector(self, session: Session, rec: NutritionLookup) -> list[float]:
+        """
+        Returns the nutrient vector for a lookup row, backfilling rows stored before vectors existed
+        with one call to the USDA details endpoint. Energy always comes from calories_per_100g, which
+        correct_lookup() may have changed after the vector was stored.
+        """
+        if rec.nutrients is None:
+            data = self.safe_api_get(
+                f"https://api.nal.usda.gov/fdc/v1/food/{rec.usda_fdc_id}", params={"api_key": USDA_API_KEY}
+            ) if rec.usda_fdc_id else None
+            vec = self.extract_nutrient_vector_from_food(data or {})
+            vec[0] = rec.calories_per_100g
+            rec.nutrients = vec
+            session.add(rec)
+        vec = list(rec.nutrients)
+        vec[0] = rec.calories_per_100g
+        return vec
+
+    def macro_report(self, session: Session, weekly_plan: Union[WeeklyPlan, CompactPlan]) -> dict:
+        """
+        Per-meal, per-day and weekly nutrient totals for a plan, computed as matrix products:
+            meal_totals = G @ V    G: meals x foods grams/100, V: foods x NUTRIENTS per 100g
+            day_totals  = D @ meal_totals   D: days x meals occurrence counts
+        Ingredients that have not been costed yet (no lookup row) are left out and counted in "missing".
+        """
+        plan_meals = list(iter_meals(weekly_plan))
+        days = list(dict.fromkeys(day for day, _, _ in plan_meals))
+        names = sorted({m.name for _, _, m in plan_meals})
+        resolved = resolve_meal_names(session, names)
+        meal_idx = {n.lower(): i for i, n in enumerate(names)}
+        # several plan names can resolve to the same canonical meal
+        rows_for = defaultdict(list)
+        for n in names:
+            if n.lower() in resolved:
+                rows_for[resolved[n.lower()].id].append(meal_idx[n.lower()])
+        rows = (
+            session.query(MealIngredient, NutritionLookup)
+            .outerjoin(NutritionLookup, NutritionLookup.name == MealIngredient.lookup_name)
+            .filter(MealIngredient.meal_id.in_(list(rows_for)))
+            .all()
+        ) if rows_for else []
+        food_idx = {}
+        vectors = []
+        entries = []
+        missing = 0
+        for ing, rec in rows:
+            if rec is None and ing.cals_per_100g is not None and ing.lookup_name is None:
+                rec = self.link_lookup(session, ing)
+            if rec is None:
+                missing += 1
+                continue
+            if ing.grams is None:
+                ing.grams = self.convert_to_grams(ing.quantity, ing.unit, ing.fdc_id)
+                session.add(ing)
+            if rec.name not in food_idx:
+                food_idx[rec.name] = len(vectors)
+                vectors.append(self.nutrient_vector(session, rec))
+            for i in rows_for[ing.meal_id]:
+                entries.append((i, food_idx[rec.name], ing.grams / 100.0))
+
+        G = np.zeros((len(names), len(vectors)))
+        for i, j, g in entries:
+            G[i, j] += g
+        V = np.array(vectors, dtype=float).reshape(len(vectors), len(NUTRIENTS))
+        meal_totals = G @ V
+
+        D = np.zeros((len(days), len(names)))
+        day_idx = {day: d for d, day in enumerate(days)}
+        for day, _, meal in plan_meals:
+            D[day_idx[day], meal_idx[meal.name.lower()]] += 1
+        day_totals = D @ meal_totals
+
+        return {
+            "nutrients": list(NUTRIENTS),
+            "meals": {n: meal_totals[i].tolist() for i, n in enumerate(names)},
+            "days": {day: day_totals[d].tolist() for d, day in enumerate(days)},
+            "week": day_totals.sum(axis=0).tolist(),
+            "missing": missing,
+        }
+
     def get_calories_for_item(
         self, session: Session, raw_name: str
     ) -> tuple[float, str]:
@@ -250,17 +512,18 @@ class NutritionAgent:
         best, _ = max(scores, key=lambda x: x[1], default=(None, 0))
         food = candidates.get(best, {})
         fdc_id = str(food.get("fdcId", ""))
-        kcal   = self.extract_energy_kcal_from_food(food)
+        nutrients = self.extract_nutrient_vector_from_food(food)
+        kcal   = nutrients[0]
 
         #insert into nutrition_lookup
         session.execute(
             text(
                 "INSERT INTO nutrition_lookup "
-                "(name, raw_name, usda_fdc_id, calories_per_100g) "
-                "VALUES (:n, :r, :id, :k) "
+                "(name, raw_name, usda_fdc_id, calories_per_100g, nutrients) "
+                "VALUES (:n, :r, :id, :k, :v) "
                 "ON CONFLICT (name) DO NOTHING"
             ),
-            {"n": norm, "r": raw_name, "id": fdc_id, "k": kcal},
+            {"n": norm, "r": raw_name, "id": fdc_id, "k": kcal, "v": nutrients},
         )
         session.commit()
         return kcal, fdc_id
@@ -0,0 +1,79 @@
+# fast in-memory nutrition estimate for candidate plans, used to pick the best of several LLM generations
+# nutrition_lookup is loaded once per process, estimates never call the USDA API or write to the database
+
+from typing import Dict, Optional
+
+import numpy as np #type: ignore
+from db import SessionLocal, NutritionLookup
+from models import WeeklyPlan
+from nutrition_agent import NutritionAgent, NUTRIENTS
+
+
+class NutritionEstimator:
+    _shared: Optional["NutritionEstimator"] = None
+
+    def __init__(self, lookup: Dict[str, np.ndarray]):
+        self.lookup = lookup # normalized name -> per-100g vector in NUTRIENTS order
+        self.helper = NutritionAgent() # for normalize / convert_to_grams
+
+    @classmethod
+    def shared(cls) -> "NutritionEstimator":
+        """Process-wide instance, loads nutrition_lookup on first use."""
+        if cls._shared is None:
+            cls._shared = cls(cls.load_lookup())
+        return cls._shared
+
+    @staticmethod
+    def load_lookup() -> Dict[str, np.ndarray]:
+        # rows stored before nutrient vectors existed only know energy, their macros are NaN (left out of totals)
+        with SessionLocal() as session:
+            rows = session.query(
+                NutritionLookup.name, NutritionLookup.calories_per_100g, NutritionLookup.nutrients
+            ).all()
+        lookup = {}
+        for name, kcal, nutrients in rows:
+            vec = np.full(len(NUTRIENTS), np.nan)
+            if nutrients:
+                vec[:len(nutrients)] = nutrients
+            vec[0] = kcal
+            lookup[name.lower()] = vec
+        print(f"Loaded {len(lookup)} nutrition_lookup rows for estimation")
+        return lookup
+
+    def estimate(self, plan: WeeklyPlan) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (days x NUTRIENTS totals, NUTRIENTS coverage) where coverage[k] is the fraction of ingredient
+        lines whose value for nutrient k is known. Lines missing from the lookup, and macros of rows stored
+        before nutrient vectors existed (NaN), add nothing to the totals and count against that nutrient only.
+        """
+        totals = np.zeros((len(plan.days), len(NUTRIENTS)))
+        known = np.zeros(len(NUTRIENTS))
+        lines = 0
+        for d, meals in enumerate(plan.days.values()):
+            for meal in meals.values():
+                for ing in meal.ingredients:
+                    lines += 1
+                    vec = self.lookup.get(self.helper.normalize(ing.name))
+                    if vec is None:
+                        continue
+                    mask = ~np.isnan(vec)
+                    known += mask
+                    # fdc_id=None keeps conversion offline (unit table only)
+                    grams = self.helper.convert_to_grams(ing.quantity, ing.unit, None)
+                    totals[d] += np.where(mask, vec, 0.0) * (grams / 100.0)
+        return totals, known / max(1, lines)
+
+    def score(self, plan: WeeklyPlan, targets: Dict[str, float]) -> float:
+        """
+        Distance of a plan from per-day targets (e.g. {"energy_kcal": 2000, "protein_g": 120}): for each
+        targeted nutrient the mean relative error over days plus the fraction of lines with that nutrient
+        unknown, averaged over targeted nutrients. A plan cannot score well on protein by having no protein data.
+        Lower is better, 0 is a perfect match.
+        """
+        cols = [NUTRIENTS.index(k) for k in targets]
+        target = np.array([targets[k] for k in targets], dtype=float)
+        totals, coverage = self.estimate(plan)
+        if not cols or totals.shape[0] == 0:
+            return 1.0 - float(coverage[0])
+        rel_err = np.abs(totals[:, cols] - target) / np.maximum(target, 1e-9)
+        return float((rel_err.mean(axis=0) + (1.0 - coverage[cols])).mean())
@@ -2,51 +2,94 @@
 #the import of db will execute the top level code in db.py, creating the tables if they don't exist and configure the engine
 
 
+import json
+import uuid
 from agent import Agent
-from db import SessionLocal, MealPlan, Meal, MealIngredient, ShoppingItem
+from models import parse_tags
+from typing import Optional
+from db import SessionLocal, MealPlan, Meal, MealAlias, MealIngredient, ShoppingItem
+from dedup import find_duplicate, index_meal
+from compact_plan import iter_meals
+from canonical import Canonicalizer
 
 class PersistenceAgent(Agent):
+    # dedup maps near-duplicate meal names onto an existing canonical meal instead of inserting a new meals row
+    def __init__(self, dedup: bool = True):
+        self.dedup = dedup
+
+    def find_canonical(self, session, meal) -> Optional[Meal]:
+        alias = session.get(MealAlias, meal.name)
+        if alias:
+            return session.get(Meal, alias.meal_id)
+        if not self.dedup:
+            return None
+        canonical = find_duplicate(session, meal.name, [i.name for i in meal.ingredients])
+        if canonical:
+            print(f"Meal '{meal.name}' is a near-duplicate of '{canonical.meal_name}'")
+            session.add(MealAlias(alias=meal.name, meal_id=canonical.id))
+            session.flush() # so a repeat of this name later in the plan finds the alias
+        return canonical
+
     def run(self, context):
         weekly_plan = context["weekly_plan"]
-        tags = context.get("dietary_tags", [])
-        plan_json = weekly_plan.json()
+        tags = parse_tags(context.get("dietary_tags", []))
+        # stored as a JSON object (not a JSON string) so the GIN index on plan_json can serve containment queries
+        plan_json = json.loads(weekly_plan.json())
+        # checkpointed runs use their run ID as the plan ID, so re-running this stage is idempotent
+        plan_id = uuid.UUID(str(context["run_id"])) if context.get("run_id") else uuid.uuid4()
 
+        # same canonical names the collector merged the shopping list on, new ingredients are created in this transaction
+        canon = Canonicalizer.shared()
         with SessionLocal() as session:
             # begin a transaction
             with session.begin():
+                # plan, meals and shopping items are written in one transaction, so if the plan exists the rest does too
+                if session.get(MealPlan, plan_id) is not None:
+                    print(f"Plan {plan_id} already persisted, skipping.")
+                    context["db_plan_id"] = plan_id
+                    return context
+
                 # 1. Create the MealPlan
-                db_plan = MealPlan(dietary_tags=tags, plan_json=plan_json)
+                db_plan = MealPlan(id=plan_id, dietary_tags=tags, plan_json=plan_json)
                 session.add(db_plan)
                 session.flush() # Ensure db_plan.id is populated
 
                 # 2. Persist Meals & Ingredients, skipping duplicates
-                for day, meals in weekly_plan.days.items():
-                    for meal_type, meal in meals.items():
-                        # a) Try to load an existing meal by name
-                        db_meal = (
-                            session.query(Meal)
-                                   .filter_by(meal_name=meal.name)
+                for day, meal_type, meal in iter_meals(weekly_plan):
+                    # a) Try to load an existing meal by name
+                    db_meal = (
+                        session.query(Meal)
+                               .filter_by(meal_name=meal.name)
+                               .one_or_none()
+                    )
+                    if not db_meal:
+                        # a name merged onto a canonical meal earlier, or a near-duplicate of a stored meal
+                        # keeps the canonical meal's ingredients (they are not merged in)
+                        canonical = self.find_canonical(session, meal)
+                        if canonical:
+                            continue
+                        db_meal = Meal(meal_name=meal.name)
+                        session.add(db_meal)
+                        session.flush()  # assign ID
+                        index_meal(session, db_meal.id, meal.name, [i.name for i in meal.ingredients])
+
+                    # b) For each ingredient, insert only if it doesn't exist (means meals can be updated)
+                    # a changed meal is marked dirty (calories_total = NULL) so NutritionAgent re-costs it
+                    for ing in meal.ingredients:
+                        exists = (
+                            session.query(MealIngredient)
+                                   .filter_by(meal_id=db_meal.id, name=ing.name)
                                    .one_or_none()
                         )
-                        if not db_meal:
-                            db_meal = Meal(meal_name=meal.name)
-                            session.add(db_meal)
-                            session.flush()  # assign ID
-
-                        # b) For each ingredient, insert only if it doesn't exist (means meals can be updated)
-                        for ing in meal.ingredients:
-                            exists = (
-                                session.query(MealIngredient)
-                                       .filter_by(meal_id=db_meal.id, name=ing.name)
-                                       .one_or_none()
-                            )
-                            if not exists:
-                                session.add(MealIngredient(
-                                    meal_id=db_meal.id,
-                                    name=ing.name,
-                                    quantity=ing.quantity,
-                                    unit=ing.unit
-                                ))
+                        if not exists:
+                            session.add(MealIngredient(
+                                meal_id=db_meal.id,
+                                name=ing.name,
+                                quantity=ing.quantity,
+                                unit=ing.unit,
+                                ingredient_id=canon.resolve(session, ing.name)[0]
+                            ))
+                            db_meal.calories_total = None
 
                 # 3. Persist Shopping Items
                 for ing in context["shopping_list"]:
@@ -54,7 +97,8 @@ class PersistenceAgent(Agent):
                         plan=db_plan,
                         name=ing.name,
                         quantity=ing.quantity,
-                        unit=ing.unit
+                        unit=ing.unit,
+                        ingredient_id=canon.resolve(session, ing.name)[0]
                     ))
 
             # transaction commits here
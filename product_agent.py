@@ -0,0 +1,275 @@
+# matches shopping list items to products in a local retailer catalogue and picks the cheapest packs
+# the catalogue (CSV or JSONL with sku, name, pack_size, pack_unit, price) is loaded once into an exact-name
+# dictionary plus a token inverted index, fuzzy scoring only runs on the few candidates the index returns
+
+import csv
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from functools import reduce
+from typing import Dict, List, Optional, Tuple
+
+from agent import Agent
+
+CATALOGUE_PATH = os.getenv("CATALOGUE_PATH", "catalogue.csv")
+
+# pack units converted to a base unit (g, or each for counted items), ml is treated as 1g like convert_to_grams
+UNIT_FACTORS = {
+    "g": ("g", 1), "gram": ("g", 1), "grams": ("g", 1), "kg": ("g", 1000),
+    "ml": ("g", 1), "l": ("g", 1000), "litre": ("g", 1000), "liter": ("g", 1000), "cl": ("g", 10),
+    "each": ("each", 1), "ea": ("each", 1), "pc": ("each", 1), "piece": ("each", 1), "pack": ("each", 1),
+}
+
+SIZE_PATTERN = re.compile(r"\b\d*\.?\d+\s*(?:x\s*\d+\s*)?(?:g|kg|ml|l|cl|pk|pack)\b")
+WORD_PATTERN = re.compile(r"[a-z]+")
+MIN_FUZZY_SCORE = 60
+MAX_CANDIDATES = 25
+SIZE_RESOLUTION = 10    # pack sizes are compared in 0.1 base units
+
+
+def to_base(qty: float, unit: str) -> Optional[Tuple[str, float]]:
+    factor = UNIT_FACTORS.get((unit or "").lower().strip())
+    if factor is None:
+        return None
+    base, mult = factor
+    return base, qty * mult
+
+
+def name_tokens(name: str) -> List[str]:
+    # drops pack sizes ("500g", "6 x 330ml") and plural endings so product names group across sizes
+    name = SIZE_PATTERN.sub(" ", name.lower())
+    tokens = []
+    for tok in WORD_PATTERN.findall(name):
+        if tok.endswith("ies") and len(tok) > 4:
+            tok = tok[:-3] + "y"
+        elif tok.endswith("s") and not tok.endswith("ss") and len(tok) > 3:
+            tok = tok[:-1]
+        tokens.append(tok)
+    return tokens
+
+
+class CoverTable:
+    """
+    Cheapest way to buy at least a quantity from one product group's packs (unbounded knapsack DP).
+    Sizes are counted in units of their GCD, cost[c] is the cheapest combination totalling exactly c units, and the
+    table only grows, so it is shared by every quantity asked of the group.
+    Some optimal cover uses fewer non-best-value packs than the best-value pack's size in units (any larger set has
+    a subset whose size is a multiple of it, which the best-value pack buys no dearer), so large quantities take
+    best-value packs up front and the DP never runs past (best size x largest size) units.
+    """
+    def __init__(self, packs: List[tuple]):
+        self.packs = packs # (size, price, sku, name), largest first
+        scaled = [max(1, round(p[0] * SIZE_RESOLUTION)) for p in packs]
+        step = reduce(math.gcd, scaled, 0)
+        self.unit = step / SIZE_RESOLUTION # base units per DP step
+        self.sizes = [s // step for s in scaled]
+        self.prices = [p[1] for p in packs]
+        self.best = min(range(len(packs)), key=lambda i: self.prices[i] / self.sizes[i]) if packs else None
+        self.cost: List[float] = [0.0]
+        self.last: List[int] = [-1] # pack index added last to reach each size, for reconstruction
+
+    def extend(self, n: int):
+        sizes, prices, cost, last = self.sizes, self.prices, self.cost, self.last
+        for c in range(len(cost), n):
+            best, arg = math.inf, -1
+            for i, size in enumerate(sizes):
+                if size <= c:
+                    v = cost[c - size] + prices[i]
+                    if v < best:
+                        best, arg = v, i
+            cost.append(best)
+            last.append(arg)
+
+    def cover(self, qty: float) -> Tuple[float, List[Tuple[tuple, int]]]:
+        if not self.packs:
+            return math.inf, []
+        if qty <= 0:
+            return 0.0, []
+        q = math.ceil(qty / self.unit - 1e-9)
+        largest = max(self.sizes)
+        best_size = self.sizes[self.best]
+        upfront = max(0, (q - (best_size - 1) * largest) // best_size)
+        q -= upfront * best_size
+        self.extend(q + largest)
+        c = min(range(q, q + largest), key=self.cost.__getitem__)
+        if self.cost[c] == math.inf:
+            return math.inf, []
+        counts = Counter({self.best: upfront} if upfront else {})
+        while c > 0:
+            i = self.last[c]
+            counts[i] += 1
+            c -= self.sizes[i]
+        total = sum(self.prices[i] * n for i, n in counts.items())
+        return total, [(self.packs[i], counts[i]) for i in sorted(counts)]
+
+
+class ProductCatalogue:
+    _loaded: Dict[str, "ProductCatalogue"] = {}
+
+    def __init__(self):
+        self.group_names: List[str] = []              # group id -> display name
+        self.group_units: List[str] = []              # group id -> base unit
+        self.group_packs: List[List[tuple]] = []      # group id -> [(size, price, sku, name)] by size desc
+        self.by_key: Dict[Tuple[str, str], int] = {}  # (sorted token key, base unit) -> group id
+        self.postings: Dict[str, List[int]] = defaultdict(list)  # token -> group ids
+        self.query_cache: Dict[Tuple[str, str], Tuple[int, ...]] = {}
+        self.cover_tables: Dict[int, "CoverTable"] = {}  # group id -> cover DP, built on first use
+
+    @classmethod
+    def load(cls, path: str) -> "ProductCatalogue":
+        """Loads and indexes a catalogue file, cached per path for the lifetime of the process."""
+        if path not in cls._loaded:
+            cls._loaded[path] = cls.from_rows(cls.read_rows(path))
+        return cls._loaded[path]
+
+    @staticmethod
+    def read_rows(path: str) -> List[dict]:
+        with open(path, "r", encoding="utf-8") as f:
+            if path.endswith(".jsonl"):
+                return [json.loads(line) for line in f if line.strip()]
+            return list(csv.DictReader(f))
+
+    @classmethod
+    def from_rows(cls, rows: List[dict]) -> "ProductCatalogue":
+        cat = cls()
+        packs = defaultdict(list)
+        display = {}
+        skipped = 0
+        for row in rows:
+            try:
+                base = to_base(float(row["pack_size"]), row["pack_unit"])
+                price = float(row["price"])
+            except (KeyError, TypeError, ValueError):
+                base = None
+            if base is None:
+                skipped += 1
+                continue
+            tokens = name_tokens(row["name"])
+            key = (" ".join(sorted(set(tokens))), base[0])
+            packs[key].append((base[1], price, str(row["sku"]), row["name"]))
+            display.setdefault(key, " ".join(tokens))
+
+        for key, group in packs.items():
+            gid = len(cat.group_names)
+            cat.by_key[key] = gid
+            cat.group_names.append(display[key])
+            cat.group_units.append(key[1])
+            # keep only the cheapest SKU per pack size, largest packs first for the cover search
+            cheapest = {}
+            for pack in group:
+                if pack[0] > 0 and (pack[0] not in cheapest or pack[1] < cheapest[pack[0]][1]):
+                    cheapest[pack[0]] = pack
+            cat.group_packs.append(sorted(cheapest.values(), reverse=True))
+            for tok in set(key[0].split()):
+                cat.postings[tok].append(gid)
+        print(f"Indexed {len(rows) - skipped} SKUs into {len(cat.group_names)} products ({skipped} rows skipped)")
+        return cat
+
+    def find_groups(self, query: str, unit: str) -> Tuple[int, ...]:
+        """
+        Returns matching product group ids for a normalized query, best first (memoized per query).
+        Exact token-set hits return immediately; otherwise the rarest query tokens' postings give the
+        candidates, which are ranked by token overlap and then fuzzy scored.
+        """
+        key = (query, unit)
+        if key not in self.query_cache:
+            self.query_cache[key] = self._find_groups(query, unit)
+        return self.query_cache[key]
+
+    def _find_groups(self, query: str, unit: str) -> Tuple[int, ...]:
+        tokens = name_tokens(query)
+        exact = self.by_key.get((" ".join(sorted(set(tokens))), unit))
+        if exact is not None:
+            return (exact,)
+
+        known = sorted((t for t in set(tokens) if t in self.postings), key=lambda t: len(self.postings[t]))
+        if not known:
+            return ()
+        overlap = Counter()
+        for tok in known[:3]:
+            overlap.update(g for g in self.postings[tok] if self.group_units[g] == unit)
+        candidates = [g for g, _ in overlap.most_common(MAX_CANDIDATES)]
+
+        from rapidfuzz import fuzz #type: ignore
+        text = " ".join(tokens)
+        scored = [(fuzz.token_set_ratio(text, self.group_names[g]), g) for g in candidates]
+        best = max((s for s, _ in scored), default=0)
+        if best < MIN_FUZZY_SCORE:
+            return ()
+        # every group close to the best match competes on price
+        return tuple(g for s, g in sorted(scored, reverse=True) if s >= best - 5)
+
+    def cover_table(self, gid: int) -> "CoverTable":
+        table = self.cover_tables.get(gid)
+        if table is None:
+            table = self.cover_tables[gid] = CoverTable(self.group_packs[gid])
+        return table
+
+    @staticmethod
+    def cheapest_cover(packs: List[tuple], qty: float) -> Tuple[float, List[Tuple[tuple, int]]]:
+        """Cheapest multiset of packs whose total size is at least qty (one-off, match() reuses a table per group)."""
+        return CoverTable(packs).cover(qty)
+
+    def match(self, name: str, quantity: float, unit: str) -> Optional[dict]:
+        base = to_base(quantity, unit)
+        if base is None:
+            return None
+        base_unit, qty = base
+        best = None
+        for gid in self.find_groups(name.lower().strip(), base_unit):
+            cost, chosen = self.cover_table(gid).cover(qty)
+            if chosen and (best is None or cost < best["cost"]):
+                best = {
+                    "item": name,
+                    "quantity": quantity,
+                    "unit": unit,
+                    "product": self.group_names[gid],
+                    "packs": [
+                        {"sku": sku, "name": pname, "size": size, "unit": base_unit, "price": price, "count": n}
+                        for (size, price, sku, pname), n in chosen
+                    ],
+                    "cost": round(cost, 2),
+                }
+        return best
+
+    def match_all(self, items: List[tuple]) -> Tuple[List[dict], List[tuple]]:
+        """
+        Bulk mode: (name, quantity, unit) items are merged by name and base unit first, so repeated
+        items across a plan (or several plans) are matched and costed once.
+        Returns (matches, unmatched items).
+        """
+        merged = {}
+        unmatched = []
+        for name, qty, unit in items:
+            base = to_base(qty, unit)
+            if base is None:
+                unmatched.append((name, qty, unit))
+                continue
+            key = (name.lower().strip(), base[0])
+            merged[key] = merged.get(key, 0.0) + base[1]
+
+        matches = []
+        for (name, base_unit), qty in merged.items():
+            m = self.match(name, qty, base_unit)
+            if m is None:
+                unmatched.append((name, qty, base_unit))
+            else:
+                matches.append(m)
+        return matches, unmatched
+
+
+#requires context to have a shopping_list key with Ingredient objects
+class ProductMatchAgent(Agent):
+    def __init__(self, catalogue_path: Optional[str] = None):
+        self.catalogue = ProductCatalogue.load(catalogue_path or CATALOGUE_PATH)
+
+    def run(self, context):
+        items = [(ing.name, ing.quantity, ing.unit) for ing in context["shopping_list"]]
+        matches, unmatched = self.catalogue.match_all(items)
+        context["basket"] = matches
+        context["basket_total"] = round(sum(m["cost"] for m in matches), 2)
+        context["unmatched_items"] = unmatched
+        print(f"Matched {len(matches)} items, {len(unmatched)} unmatched, basket total {context['basket_total']}")
+        return context
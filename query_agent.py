@@ -0,0 +1,168 @@
+# read path for saved plans and meals, every query is a single round trip served by the indexes in db.SCHEMA_UPGRADES (cli.py migrate)
+# list queries use keyset pagination (an opaque cursor from the last row) instead of OFFSET, so page N costs the same as page 1
+
+import json
+import uuid
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text #type: ignore
+from db import SessionLocal
+
+# plan, shopping list and per-meal calories in one statement, merged meal names resolve through meal_aliases
+PLAN_QUERY = text("""
+    SELECT p.id, p.created_at, p.dietary_tags, p.plan_json,
+        COALESCE((
+            SELECT json_agg(json_build_object('name', s.name, 'quantity', s.quantity, 'unit', s.unit) ORDER BY s.name)
+            FROM shopping_items s
+            WHERE s.plan_id = p.id
+        ), '[]') AS shopping_list,
+        COALESCE((
+            SELECT json_object_agg(n.name, m.calories_total)
+            FROM (SELECT DISTINCT jsonb_path_query(p.plan_json, '$.days.*.*.name') #>> '{}' AS name) n
+            JOIN meals m ON m.id = COALESCE(
+                (SELECT id FROM meals WHERE meal_name = n.name::citext),
+                (SELECT meal_id FROM meal_aliases WHERE alias = n.name::citext)
+            )
+        ), '{}') AS meal_calories
+    FROM meal_plans p
+    WHERE p.id = :id
+""")
+
+# every lowercased spelling of a meal: the name given, its canonical meal's name and all aliases of that meal
+SPELLINGS_SQL = """
+    WITH target AS (
+        SELECT COALESCE(
+            (SELECT id FROM meals WHERE meal_name = CAST(:name AS CITEXT)),
+            (SELECT meal_id FROM meal_aliases WHERE alias = CAST(:name AS CITEXT))
+        ) AS id
+    )
+    SELECT array_agg(DISTINCT lower(n)) FROM (
+        SELECT CAST(:name AS TEXT) AS n
+        UNION ALL SELECT m.meal_name::text FROM meals m JOIN target t ON m.id = t.id
+        UNION ALL SELECT a.alias::text FROM meal_aliases a JOIN target t ON a.meal_id = t.id
+    ) spellings
+"""
+
+
+def encode_cursor(*values) -> str:
+    return "|".join(v.isoformat() if isinstance(v, datetime) else str(v) for v in values)
+
+
+class QueryAgent:
+    def get_plan(self, plan_id: str) -> Optional[dict]:
+        """
+        Fetches a plan with its shopping list and nutrition (per-meal, per-day and weekly calories).
+        """
+        with SessionLocal() as session:
+            row = session.execute(PLAN_QUERY, {"id": str(uuid.UUID(plan_id))}).mappings().one_or_none()
+        if row is None:
+            return None
+        plan_json = row["plan_json"]
+        if isinstance(plan_json, str): # older plans were stored as a JSON string
+            plan_json = json.loads(plan_json)
+        meal_cals = {k.lower(): v for k, v in row["meal_calories"].items()}
+
+        day_cals = {}
+        for day, meals in plan_json.get("days", {}).items():
+            cals = [meal_cals.get(m["name"].lower()) for m in meals.values()]
+            day_cals[day] = None if any(c is None for c in cals) else sum(cals)
+        week = None if any(c is None for c in day_cals.values()) else sum(day_cals.values())
+
+        return {
+            "id": str(row["id"]),
+            "created_at": row["created_at"].isoformat(),
+            "dietary_tags": row["dietary_tags"],
+            "plan": plan_json,
+            "shopping_list": row["shopping_list"],
+            "nutrition": {"meals": row["meal_calories"], "days": day_cals, "week": week},
+        }
+
+    def meals_with_ingredient(self, ingredient: str, fuzzy: bool = False, limit: int = 50,
+                              cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Meals containing an ingredient, ordered by meal name.
+        Exact matches use the CITEXT btree index on meal_ingredients.name, fuzzy (substring) matches the trigram index.
+        Returns (rows, next cursor or None).
+        """
+        if fuzzy:
+            # % and _ in the ingredient are literal characters, not wildcards
+            escaped = ingredient.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            cond = "mi.name::text ILIKE :pattern ESCAPE '\\'"
+            params = {"pattern": f"%{escaped}%"}
+        else:
+            cond = "mi.name = :name"
+            params = {"name": ingredient}
+        after = ""
+        if cursor:
+            after = "AND m.meal_name > :after"
+            params["after"] = cursor
+        params["limit"] = limit
+        sql = text(f"""
+            SELECT m.id, m.meal_name, m.calories_total
+            FROM meals m
+            WHERE EXISTS (SELECT 1 FROM meal_ingredients mi WHERE mi.meal_id = m.id AND {cond})
+            {after}
+            ORDER BY m.meal_name
+            LIMIT :limit
+        """)
+        with SessionLocal() as session:
+            rows = [dict(r) for r in session.execute(sql, params).mappings()]
+        next_cursor = rows[-1]["meal_name"] if len(rows) == limit else None
+        return rows, next_cursor
+
+    def plans_by_tag(self, tags: List[str], limit: int = 50,
+                     cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Plans whose dietary_tags contain all of the given tags, newest first (GIN on dietary_tags).
+        """
+        return self._plan_page("p.dietary_tags @> CAST(:tags AS TEXT[])", {"tags": tags}, limit, cursor)
+
+    def plans_with_meal(self, meal_name: str, limit: int = 50,
+                        cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Plans that use a meal in any slot, newest first, matching case-insensitively like the CITEXT meal columns.
+        The name is first expanded to every spelling of the same meal (the canonical meal name and its
+        meal_aliases), then plans are found by overlap with the GIN indexed plan_meal_names(plan_json).
+        """
+        # the spellings subquery is uncorrelated, so it runs once and its array drives the index scan
+        return self._plan_page(f"plan_meal_names(p.plan_json) && ({SPELLINGS_SQL})", {"name": meal_name}, limit, cursor)
+
+    def _plan_page(self, cond: str, params: dict, limit: int, cursor: Optional[str]):
+        # keyset pagination on (created_at, id), matching the ix_meal_plans_created_id index
+        after = ""
+        if cursor:
+            created_at, last_id = cursor.split("|")
+            after = "AND (p.created_at, p.id) < (CAST(:after_ts AS TIMESTAMPTZ), CAST(:after_id AS UUID))"
+            params.update(after_ts=created_at, after_id=last_id)
+        params["limit"] = limit
+        sql = text(f"""
+            SELECT p.id, p.created_at, p.dietary_tags
+            FROM meal_plans p
+            WHERE {cond} {after}
+            ORDER BY p.created_at DESC, p.id DESC
+            LIMIT :limit
+        """)
+        with SessionLocal() as session:
+            rows = [dict(r) for r in session.execute(sql, params).mappings()]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if len(rows) == limit else None
+        return rows, next_cursor
+
+    def fix_legacy_plans(self, batch_size: int = 10000) -> int:
+        """
+        Converts plan_json values stored as JSON strings (before PersistenceAgent stored objects) into objects,
+        so plan_meal_names (and its index) sees their meals. Runs in batches, returns the number of rows converted.
+        """
+        total = 0
+        with SessionLocal() as session:
+            while True:
+                n = session.execute(text("""
+                    UPDATE meal_plans SET plan_json = (plan_json #>> '{}')::jsonb
+                    WHERE id IN (
+                        SELECT id FROM meal_plans WHERE jsonb_typeof(plan_json) = 'string' LIMIT :n
+                    )
+                """), {"n": batch_size}).rowcount
+                session.commit()
+                total += n
+                if n < batch_size:
+                    return total
@@ -0,0 +1,254 @@
+# composes a weekly plan from meals already stored in the database, before falling back to the LLM
+# an in-memory index over meal names, ingredient tokens, meal slots and cached calorie totals is built once per process
+# slots it cannot fill are listed in context["unfilled_slots"] for LLMMealPlanAgent to generate
+
+import bisect
+import random
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import text #type: ignore
+from agent import Agent
+from db import SessionLocal, Meal as DBMeal, MealIngredient
+from models import Ingredient, Meal, WeeklyPlan, parse_tags
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+SLOTS = ["breakfast", "lunch", "dinner"]
+# share of the daily calorie target each slot aims for
+SLOT_SHARE = {"breakfast": 0.25, "lunch": 0.35, "dinner": 0.40}
+
+# ingredient / name terms excluded by each dietary tag, a multi-word term ("soy sauce") matches when all its words appear
+# terms are run through tokenize() below, so they can be written naturally ("mussels", "anchovies")
+MEAT = {"beef", "steak", "sirloin", "ribeye", "brisket", "veal", "pork", "bacon", "ham", "pancetta", "prosciutto",
+        "salami", "pepperoni", "chorizo", "sausage", "hot dog", "meatball", "meatloaf", "mince", "pastrami", "jerky",
+        "chicken", "turkey", "duck", "goose", "quail", "lamb", "mutton", "goat", "venison", "rabbit", "liver",
+        "gelatin", "lard", "suet", "bone broth"}
+SEAFOOD = {"fish", "salmon", "tuna", "cod", "haddock", "halibut", "tilapia", "trout", "mackerel", "sardines",
+           "anchovies", "herring", "sea bass", "snapper", "swordfish", "shrimp", "prawn", "crab", "lobster",
+           "crayfish", "mussels", "clams", "oysters", "scallops", "squid", "calamari", "octopus", "caviar", "roe",
+           "surimi", "worcestershire"}
+DAIRY = {"milk", "cheese", "butter", "buttermilk", "cream", "yogurt", "yoghurt", "ghee", "whey", "casein", "kefir",
+         "parmesan", "mozzarella", "feta", "cheddar", "ricotta", "mascarpone", "paneer", "halloumi", "brie", "gouda",
+         "gruyere", "camembert", "emmental", "pecorino", "burrata", "quark", "custard", "creme fraiche"}
+GLUTEN = {"wheat", "flour", "bread", "breadcrumbs", "panko", "crouton", "pasta", "spaghetti", "penne", "fusilli",
+          "macaroni", "linguine", "fettuccine", "lasagna", "lasagne", "ravioli", "tortellini", "orzo", "gnocchi",
+          "noodles", "ramen", "udon", "couscous", "bulgur", "barley", "rye", "spelt", "semolina", "farro", "seitan",
+          "tortilla", "wrap", "bagel", "cracker", "croissant", "pita", "naan", "bun", "baguette", "brioche", "dough",
+          "pizza", "pastry", "pie crust", "cake", "cookie", "muffin", "pancake", "waffle", "biscuit", "batter",
+          "beer", "malt", "soy sauce", "teriyaki", "hoisin"}
+DIET_EXCLUSIONS = {
+    "vegetarian": MEAT | SEAFOOD,
+    "pescatarian": MEAT,
+    "dairy-free": DAIRY,
+    "gluten-free": GLUTEN,
+    "keto": {"rice", "pasta", "bread", "potato", "sugar", "flour", "oat", "noodle", "tortilla", "banana", "honey",
+             "quinoa", "corn", "bean", "lentil", "chickpea", "couscous", "syrup", "cereal", "granola", "juice",
+             "mango", "pineapple", "grape", "raisin"} | (GLUTEN - {"beer", "malt", "soy sauce", "teriyaki"}),
+}
+DIET_EXCLUSIONS["vegan"] = DIET_EXCLUSIONS["vegetarian"] | DAIRY | {
+    "egg", "mayonnaise", "mayo", "aioli", "meringue", "honey",
+}
+
+# collects every (meal name, slot) pair used in saved plans, older plans stored plan_json as a JSON string
+SLOT_QUERY = text("""
+    SELECT DISTINCT lower(slot.value->>'name') AS meal_name, slot.key AS slot
+    FROM meal_plans p
+    CROSS JOIN LATERAL jsonb_each(
+        (CASE jsonb_typeof(p.plan_json) WHEN 'string' THEN (p.plan_json #>> '{}')::jsonb ELSE p.plan_json END)->'days'
+    ) AS day
+    CROSS JOIN LATERAL jsonb_each(day.value) AS slot
+    WHERE jsonb_typeof(day.value) = 'object'
+""")
+
+# meal names used in saved plans per dietary tag, the only candidates a tag allows (see MealIndex.excluded)
+TAG_QUERY = text("""
+    SELECT DISTINCT lower(slot.value->>'name') AS meal_name, lower(tag) AS tag
+    FROM meal_plans p
+    CROSS JOIN LATERAL unnest(p.dietary_tags) AS tag
+    CROSS JOIN LATERAL jsonb_each(
+        (CASE jsonb_typeof(p.plan_json) WHEN 'string' THEN (p.plan_json #>> '{}')::jsonb ELSE p.plan_json END)->'days'
+    ) AS day
+    CROSS JOIN LATERAL jsonb_each(day.value) AS slot
+    WHERE jsonb_typeof(day.value) = 'object'
+""")
+
+
+def tokenize(value: str) -> Set[str]:
+    # lowercase word tokens with a crude plural strip, so "berries"/"berry" and "oats"/"oat" match
+    tokens = set()
+    for tok in re.findall(r"[a-z]+", value.lower()):
+        if tok.endswith("ies") and len(tok) > 4:
+            tok = tok[:-3] + "y"
+        elif tok.endswith("s") and not tok.endswith("ss") and len(tok) > 3:
+            tok = tok[:-1]
+        tokens.add(tok)
+    return tokens
+
+
+# DIET_EXCLUSIONS as token sets, matching how meal names and ingredients are tokenized
+DIET_TERMS = {tag: [frozenset(tokenize(term)) for term in terms] for tag, terms in DIET_EXCLUSIONS.items()}
+
+
+def diet_violation(tags: List[str], name: str, ingredients: List[str]) -> Optional[str]:
+    """The first excluded term a meal contains for any of the tags, or None (word check only)."""
+    tokens = tokenize(name)
+    for ing in ingredients:
+        tokens |= tokenize(ing)
+    for tag in tags:
+        for term in DIET_TERMS.get(tag, ()):
+            if term <= tokens:
+                return " ".join(sorted(term))
+    return None
+
+
+class MealIndex:
+    _shared: Optional["MealIndex"] = None
+
+    def __init__(self):
+        self.ids: list = []                     # meal UUIDs, position = meal index
+        self.names: List[str] = []
+        self.calories: List[Optional[float]] = []
+        self.tokens: Dict[str, Set[int]] = defaultdict(set)  # token -> meal indices (name + ingredients)
+        self.by_slot: Dict[str, list] = {}      # slot -> [(calories, idx)] sorted, costed meals only
+        self.uncosted_by_slot: Dict[str, List[int]] = {}
+        self.by_tag: Dict[str, Set[int]] = {}   # dietary tag -> meals used in plans saved with that tag
+
+    @classmethod
+    def shared(cls) -> "MealIndex":
+        if cls._shared is None:
+            cls._shared = cls.build()
+        return cls._shared
+
+    @classmethod
+    def build(cls) -> "MealIndex":
+        index = cls()
+        pos = {}
+        with SessionLocal() as session:
+            for meal_id, name, cals in session.query(DBMeal.id, DBMeal.meal_name, DBMeal.calories_total).yield_per(5000):
+                pos[meal_id] = len(index.ids)
+                index.ids.append(meal_id)
+                index.names.append(name)
+                index.calories.append(cals)
+                for tok in tokenize(name):
+                    index.tokens[tok].add(pos[meal_id])
+            for meal_id, ing_name in session.query(MealIngredient.meal_id, MealIngredient.name).yield_per(20000):
+                if meal_id in pos:
+                    for tok in tokenize(ing_name):
+                        index.tokens[tok].add(pos[meal_id])
+            slot_rows = session.execute(SLOT_QUERY).all()
+            tag_rows = session.execute(TAG_QUERY).all()
+
+        by_name = {n.lower(): i for i, n in enumerate(index.names)}
+        by_slot = defaultdict(list)
+        uncosted = defaultdict(list)
+        for meal_name, slot in slot_rows:
+            i = by_name.get(meal_name)
+            if i is None:
+                continue
+            if index.calories[i] is None:
+                uncosted[slot.lower()].append(i)
+            else:
+                by_slot[slot.lower()].append((index.calories[i], i))
+        index.by_slot = {slot: sorted(v) for slot, v in by_slot.items()}
+        index.uncosted_by_slot = dict(uncosted)
+        by_tag = defaultdict(set)
+        for meal_name, tag in tag_rows:
+            i = by_name.get(meal_name)
+            if i is not None:
+                by_tag[tag].add(i)
+        index.by_tag = dict(by_tag)
+        print(f"Indexed {len(index.ids)} meals, {len(index.tokens)} tokens")
+        return index
+
+    def excluded(self, tags: List[str]) -> Set[int]:
+        """
+        Indices of meals not allowed under the tags. A meal is only allowed when it was used in a plan saved with
+        every tag and none of its name / ingredient tokens match an excluded term (DIET_EXCLUSIONS). The word lists
+        can never be complete, so neither check is trusted alone. With no such meals every slot goes to the LLM.
+        """
+        out = set()
+        for tag in tags:
+            allowed = self.by_tag.get(tag, set())
+            out |= {i for i in range(len(self.ids)) if i not in allowed}
+            for term in DIET_TERMS.get(tag, ()):
+                words = iter(term)
+                meals = set(self.tokens.get(next(words), set()))
+                for tok in words:
+                    meals &= self.tokens.get(tok, set())
+                out |= meals
+        return out
+
+    def pick(self, slot: str, blocked: Set[int], target: Optional[float], rng: random.Random) -> Optional[int]:
+        """
+        Picks a meal for a slot that is not blocked.
+        With a calorie target, walks outwards from the closest calorie total (bisect on the sorted slot list),
+        otherwise samples at random.
+        """
+        costed = self.by_slot.get(slot, [])
+        if target is not None:
+            i = bisect.bisect_left(costed, (target, -1))
+            lo, hi = i - 1, i
+            while lo >= 0 or hi < len(costed):
+                # take whichever neighbour is closer to the target
+                if hi >= len(costed) or (lo >= 0 and target - costed[lo][0] <= costed[hi][0] - target):
+                    idx = costed[lo][1]
+                    lo -= 1
+                else:
+                    idx = costed[hi][1]
+                    hi += 1
+                if idx not in blocked:
+                    return idx
+            return None
+        pool = [i for _, i in costed] + self.uncosted_by_slot.get(slot, [])
+        for idx in rng.sample(pool, len(pool)):
+            if idx not in blocked:
+                return idx
+        return None
+
+
+class RetrievalPlanAgent(Agent):
+    def __init__(self, index: Optional[MealIndex] = None):
+        self.index = index
+
+    def run(self, context):
+        index = self.index or MealIndex.shared()
+        tags = parse_tags(context.get("dietary_tags", ""))
+        daily_target = (context.get("nutrition_targets") or {}).get("energy_kcal")
+        max_repeats = int(context.get("max_meal_repeats", 1))
+        rng = random.Random(context.get("seed"))
+
+        blocked = index.excluded(tags)
+        uses = defaultdict(int)
+        chosen = {}     # (day, slot) -> meal index
+        unfilled = []
+        for day in WEEKDAYS:
+            for slot in SLOTS:
+                target = daily_target * SLOT_SHARE[slot] if daily_target else None
+                idx = index.pick(slot, blocked, target, rng)
+                if idx is None:
+                    unfilled.append([day, slot])
+                    continue
+                chosen[(day, slot)] = idx
+                uses[idx] += 1
+                if uses[idx] >= max_repeats:
+                    blocked.add(idx)  # variety: each meal used at most max_repeats times a week
+
+        # load the ingredients of the chosen meals in one query
+        ingredients = defaultdict(list)
+        if chosen:
+            with SessionLocal() as session:
+                rows = session.query(MealIngredient).filter(
+                    MealIngredient.meal_id.in_({index.ids[i] for i in chosen.values()})
+                ).all()
+            for r in rows:
+                ingredients[r.meal_id].append(Ingredient(name=r.name, quantity=r.quantity, unit=r.unit))
+
+        days = {}
+        for (day, slot), idx in chosen.items():
+            days.setdefault(day, {})[slot] = Meal(name=index.names[idx], ingredients=ingredients[index.ids[idx]])
+
+        print(f"Retrieved {len(chosen)} of {len(WEEKDAYS) * len(SLOTS)} meals from the catalogue")
+        context["weekly_plan"] = WeeklyPlan(days=days)
+        context["unfilled_slots"] = unfilled
+        return context
@@ -0,0 +1,229 @@
+# compact binary snapshots of agent contexts, used by testing_cli to save and replay pipeline stages
+# contexts are packed with msgpack, WeeklyPlan / CompactPlan / Ingredient / UUID values are tagged so they round-trip
+# losslessly, and a per-directory index lets large batches of snapshots be replayed without globbing
+# the context keys are stored in a small header ahead of the payload, so indexing never has to unpack the payload
+
+import struct
+import time
+import uuid
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import msgpack #type: ignore
+from models import Ingredient, Meal, WeeklyPlan, construct
+from compact_plan import CompactPlan
+
+SCHEMA_VERSION = 2          # 2 added the keys header, version 1 files are still readable
+INDEX_VERSION = 1
+MAGIC = b"GBS"               # GroceryBot snapshot
+SUFFIX = ".ctx"
+INDEX_NAME = "index.msgpack"
+INDEX_LOG_NAME = "index.log" # entries appended since the index was last written
+HEADER_LEN = struct.Struct(">I")
+
+# header flags
+FLAG_ZLIB = 1
+
+# msgpack extension type codes
+EXT_UUID = 1
+EXT_WEEKLY_PLAN = 2
+EXT_INGREDIENT = 3
+EXT_COMPACT_PLAN = 4
+
+
+def plan_to_rows(plan: WeeklyPlan) -> list:
+    """
+    Flattens a WeeklyPlan into nested lists:
+    [[day, [[slot, meal_name, [[ing_name, qty, unit], ...]], ...]], ...]
+    """
+    return [
+        [day, [
+            [slot, meal.name, [[ing.name, ing.quantity, ing.unit] for ing in meal.ingredients]]
+            for slot, meal in meals.items()
+        ]]
+        for day, meals in plan.days.items()
+    ]
+
+
+def plan_from_rows(rows: list) -> WeeklyPlan:
+    """Inverse of plan_to_rows, the data was validated when first saved so validation is skipped."""
+    days = {}
+    for day, slots in rows:
+        days[day] = {
+            slot: construct(Meal, name=name, ingredients=[
+                construct(Ingredient, name=n, quantity=q, unit=u) for n, q, u in ings
+            ])
+            for slot, name, ings in slots
+        }
+    return construct(WeeklyPlan, days=days)
+
+
+def _default(obj: Any):
+    # called by msgpack for any type it cannot pack natively
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    if isinstance(obj, WeeklyPlan):
+        return msgpack.ExtType(EXT_WEEKLY_PLAN, msgpack.packb(plan_to_rows(obj), use_bin_type=True))
+    if isinstance(obj, CompactPlan):
+        return msgpack.ExtType(EXT_COMPACT_PLAN, msgpack.packb(obj.to_dict(), use_bin_type=True))
+    if isinstance(obj, Ingredient):
+        return msgpack.ExtType(EXT_INGREDIENT, msgpack.packb([obj.name, obj.quantity, obj.unit], use_bin_type=True))
+    raise TypeError(f"Cannot snapshot object of type {type(obj).__name__}")
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    if code == EXT_WEEKLY_PLAN:
+        return plan_from_rows(msgpack.unpackb(data, raw=False))
+    if code == EXT_COMPACT_PLAN:
+        return CompactPlan.from_dict(msgpack.unpackb(data, raw=False))
+    if code == EXT_INGREDIENT:
+        name, qty, unit = msgpack.unpackb(data, raw=False)
+        return construct(Ingredient, name=name, quantity=qty, unit=unit)
+    return msgpack.ExtType(code, data)
+
+
+def dumps(ctx: Dict[str, Any], compress: bool = False) -> bytes:
+    """
+    Packs a context into bytes: 3 byte magic, version byte, flags byte, 4 byte header length, the msgpack header
+    ({"keys": [...]}), then the (optionally zlib'd) payload.
+    """
+    payload = msgpack.packb(ctx, default=_default, use_bin_type=True)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 6)
+        flags |= FLAG_ZLIB
+    header = msgpack.packb({"keys": sorted(ctx.keys())}, use_bin_type=True)
+    return MAGIC + bytes([SCHEMA_VERSION, flags]) + HEADER_LEN.pack(len(header)) + header + payload
+
+
+def _split(data: bytes) -> Tuple[int, int, Optional[dict], int]:
+    # (version, flags, header or None for version 1, payload offset)
+    if data[:3] != MAGIC:
+        raise ValueError("Not a GroceryBot snapshot")
+    version, flags = data[3], data[4]
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"Snapshot schema version {version} is newer than supported version {SCHEMA_VERSION}")
+    if version < 2:
+        return version, flags, None, 5
+    (size,) = HEADER_LEN.unpack_from(data, 5)
+    start = 5 + HEADER_LEN.size
+    return version, flags, msgpack.unpackb(data[start:start + size], raw=False), start + size
+
+
+def loads(data: bytes) -> Dict[str, Any]:
+    _, flags, _, offset = _split(data)
+    payload = data[offset:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    return msgpack.unpackb(payload, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+def save_snapshot(ctx: Dict[str, Any], path: str, compress: bool = False) -> int:
+    """Writes a snapshot file and returns its size in bytes."""
+    data = dumps(ctx, compress=compress)
+    tmp = Path(f"{path}.tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path) # atomic, so a crash never leaves a half-written snapshot
+    return len(data)
+
+
+def load_snapshot(path: str) -> Dict[str, Any]:
+    return loads(Path(path).read_bytes())
+
+
+def read_keys(path: str) -> list:
+    """Context keys of a snapshot, reading only its header (version 1 files have none and are fully loaded)."""
+    with open(path, "rb") as f:
+        head = f.read(5 + HEADER_LEN.size)
+        if head[:3] != MAGIC:
+            raise ValueError("Not a GroceryBot snapshot")
+        if head[3] < 2:
+            return sorted(load_snapshot(path).keys())
+        (size,) = HEADER_LEN.unpack_from(head, 5)
+        return msgpack.unpackb(f.read(size), raw=False)["keys"]
+
+
+class SnapshotDir:
+    """
+    A directory of snapshots plus an index (name -> file, size, keys, saved_at).
+    Saves append one entry to index.log, flush() folds the log into index.msgpack, so writing N snapshots
+    costs O(N) index I/O. Readers replay the log on top of the index, so an unflushed log is never lost.
+    """
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / INDEX_NAME
+        self.log_path = self.root / INDEX_LOG_NAME
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+
+    @property
+    def index(self) -> Dict[str, Dict[str, Any]]:
+        if self._index is None:
+            if self.index_path.exists():
+                data = msgpack.unpackb(self.index_path.read_bytes(), raw=False)
+                self._index = data.get("entries", {}) if data.get("v") == INDEX_VERSION else self._scan()
+            else:
+                self._index = self._scan()
+            if self.log_path.exists():
+                with open(self.log_path, "rb") as f:
+                    # a torn last entry (crash mid-append) is simply not yielded
+                    for name, entry in msgpack.Unpacker(f, raw=False):
+                        self._index[name] = entry
+        return self._index
+
+    def _scan(self) -> Dict[str, Dict[str, Any]]:
+        # rebuilds the index from the files on disk, used when it is missing or out of date
+        entries = {}
+        for f in sorted(self.root.glob(f"*{SUFFIX}")):
+            stat = f.stat()
+            entries[f.name[:-len(SUFFIX)]] = {
+                "file": f.name,
+                "size": stat.st_size,
+                "keys": read_keys(str(f)),
+                "saved_at": stat.st_mtime,
+            }
+        return entries
+
+    def flush(self):
+        """Writes the full index once and clears the append log."""
+        data = msgpack.packb({"v": INDEX_VERSION, "entries": self.index}, use_bin_type=True)
+        tmp = self.index_path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        tmp.replace(self.index_path)
+        self.log_path.unlink(missing_ok=True)
+
+    def rebuild_index(self) -> int:
+        self._index = self._scan()
+        self.flush()
+        return len(self._index)
+
+    def path_for(self, name: str) -> Path:
+        return self.root / f"{name}{SUFFIX}"
+
+    def save(self, ctx: Dict[str, Any], name: str, compress: bool = False) -> Path:
+        path = self.path_for(name)
+        size = save_snapshot(ctx, str(path), compress=compress)
+        entry = {
+            "file": path.name,
+            "size": size,
+            "keys": sorted(ctx.keys()),
+            "saved_at": time.time(),
+        }
+        self.index[name] = entry
+        with open(self.log_path, "ab") as f:
+            f.write(msgpack.packb([name, entry], use_bin_type=True))
+        return path
+
+    def load(self, name: str) -> Dict[str, Any]:
+        return load_snapshot(str(self.root / self.index[name]["file"]))
+
+    def names(self) -> list[str]:
+        return sorted(self.index)
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # yields (name, context) in name order
+        for name in self.names():
+            yield name, self.load(name)
@@ -1,7 +1,7 @@
 import typer #type: ignore
 import json
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from llm_agent import LLMMealPlanAgent
 from collector_agent import IngredientCollectorAgent
 from agent import Agent
@@ -9,19 +9,35 @@ from typing import List, Dict, Any
 from persistence_agent import PersistenceAgent
 from nutrition_agent import NutritionAgent
 from models import WeeklyPlan
+from retrieval_agent import RetrievalPlanAgent, diet_violation
+from product_agent import ProductMatchAgent
+from snapshot import SnapshotDir, load_snapshot, MAGIC
 
 app = typer.Typer()
 
+ARTIFACTS_DIR = "/content/drive/MyDrive/artifacts"
+
 
 # Map short names to classes
 AGENTS_MAP = {
+    "retrieval": RetrievalPlanAgent,
     "mealplan": LLMMealPlanAgent,
     "ingredients": IngredientCollectorAgent,
     "persistence": PersistenceAgent,
     "nutrition": NutritionAgent,
+    "products": ProductMatchAgent,
 }
 
-def save_ctx(ctx: Dict[str, Any], name: str):
+def save_ctx(ctx: Dict[str, Any], name: str, fmt: str = "json", compress: bool = False,
+             snapshots: Optional[SnapshotDir] = None):
+    # compact binary snapshot, lossless and indexed per directory (pass one SnapshotDir for a batch, then flush it)
+    if fmt == "snapshot":
+        if snapshots is None:
+            snapshots = SnapshotDir(ARTIFACTS_DIR)
+            path = snapshots.save(ctx, name, compress=compress)
+            snapshots.flush()
+            return path
+        return snapshots.save(ctx, name, compress=compress)
     ctx_to_save = ctx.copy()
     # Convert weekly_plan to dict if it's a Pydantic model
     wp = ctx_to_save.get("weekly_plan")
@@ -29,11 +45,17 @@ def save_ctx(ctx: Dict[str, Any], name: str):
         ctx_to_save["weekly_plan"] = wp.model_dump()
     elif hasattr(wp, "dict"):
         ctx_to_save["weekly_plan"] = wp.dict()
-    Path("/content/drive/MyDrive/artifacts").mkdir(exist_ok=True)
-    with open(f"/content/drive/MyDrive/artifacts/{name}.json", "w") as f:
+    Path(ARTIFACTS_DIR).mkdir(exist_ok=True)
+    path = Path(ARTIFACTS_DIR) / f"{name}.json"
+    with open(path, "w") as f:
         json.dump(ctx_to_save, f, indent=2, default=str)
+    return path
 
 def load_ctx(fixture: str) -> Dict[str, Any]:
+    # binary snapshots are detected by their header, no re-validation needed
+    with open(fixture, "rb") as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            return load_snapshot(fixture)
     with open(fixture, "r") as f:
         ctx = json.load(f)
     # Convert weekly_plan dict back to WeeklyPlan model if present
@@ -58,7 +80,14 @@ def run(
     fixture: str = typer.Option(None, help="Context file to load (if not running all)"),
     model: str = typer.Option("mistralai/Mistral-7B-Instruct-v0.3"),
     device: str = typer.Option("cuda"),
+    backend: str = typer.Option("auto", help="Inference backend: auto, bnb4, cpu-int8 or onnx"),
+    threads: int = typer.Option(None, help="CPU threads used for inference"),
+    draft: str = typer.Option(None, help="Speculative decoding: 'prompt-lookup' or a small draft model name"),
+    draft_tokens: int = typer.Option(10, help="Tokens proposed by the drafter per verification step"),
+    reference_prompt: bool = typer.Option(False, help="Add the last accepted plan to the prompt as a format reference"),
     diet: str = typer.Option("", help="Dietary tags: vegan, keto, etc."),
+    fmt: str = typer.Option("json", "--format", help="Snapshot format: json or snapshot (compact binary)"),
+    compress: bool = typer.Option(False, help="zlib-compress binary snapshots"),
 ):
     """
     Run one or more agents independently, or the full pipeline ('all').
@@ -72,8 +101,8 @@ def run(
             if a not in AGENTS_MAP:
                 raise ValueError(f"Unknown agent: {a}")
 
-    # Initial context - if starting with mealplan, use diet; else load from fixture
-    if "mealplan" in selected and selected[0] == "mealplan":
+    # Initial context - if starting with retrieval or mealplan, use diet; else load from fixture
+    if selected[0] in ("retrieval", "mealplan"):
         ctx = {"dietary_tags": diet}  # starting point for plan
     elif fixture:
         ctx = load_ctx(fixture)
@@ -83,19 +112,90 @@ def run(
         raise typer.BadParameter("Must provide a fixture file unless running 'all' or starting with mealplan.")
 
     # Run chosen agents
+    snapshots = SnapshotDir(ARTIFACTS_DIR) if fmt == "snapshot" else None
     for name in selected:
         print(f"\n Running agent: {name}")
         if name == "mealplan":
-            agent = AGENTS_MAP[name](model_name=model, device=device)
+            agent = AGENTS_MAP[name](model_name=model, device=device, backend=backend, threads=threads,
+                                     draft=draft, draft_tokens=draft_tokens, reference_prompt=reference_prompt)
         else:
             agent = AGENTS_MAP[name]()
         ctx = agent.run(ctx)
-        save_ctx(ctx, name)
-        print(f"Finished {name}. Context snapshot saved to /content/drive/MyDrive/artifacts/{name}.json")
+        path = save_ctx(ctx, name, fmt=fmt, compress=compress, snapshots=snapshots)
+        print(f"Finished {name}. Context snapshot saved to {path}")
+    if snapshots:
+        snapshots.flush()
 
     print("\n Done. Final context:")
     print(json.dumps(ctx, indent=2, default=str))
 
 
+@app.command()
+def replay(
+    agents: List[str] = typer.Argument(..., help="Agents to run on every snapshot, in order"),
+    directory: str = typer.Option(ARTIFACTS_DIR, help="Snapshot directory (must contain binary snapshots)"),
+    rebuild_index: bool = typer.Option(False, help="Rescan the directory before replaying"),
+):
+    """
+    Replay a directory of binary snapshots through one or more agents, using the directory index.
+    """
+    selected = [a.lower() for a in agents]
+    for a in selected:
+        if a not in AGENTS_MAP or a in ("retrieval", "mealplan"):
+            raise ValueError(f"Cannot replay agent: {a}")
+    snapshots = SnapshotDir(directory)
+    if rebuild_index:
+        print(f"Indexed {snapshots.rebuild_index()} snapshots")
+
+    # agents are created once and reused across every snapshot
+    instances = [AGENTS_MAP[a]() for a in selected]
+    count = 0
+    for name, ctx in snapshots:
+        for agent in instances:
+            ctx = agent.run(ctx)
+        count += 1
+        print(f"Replayed {name}")
+    print(f"\n Done. Replayed {count} snapshots through {', '.join(selected)}")
+
+
+# (tag, meal name, ingredients, should be excluded) pairs the dietary word check has to get right
+DIET_CASES = [
+    ("vegetarian", "Grilled Sirloin Steak", ["sirloin steak", "garlic butter"], True),
+    ("vegetarian", "Spaghetti and Meatballs", ["spaghetti", "meatballs", "tomato sauce"], True),
+    ("vegetarian", "Crab Cakes", ["lump crab meat", "egg"], True),
+    ("vegetarian", "Lobster Roll", ["lobster tail", "brioche bun"], True),
+    ("vegetarian", "Moules Frites", ["mussels", "white wine", "fries"], True),
+    ("vegetarian", "Italian Sub", ["salami", "provolone", "sub roll"], True),
+    ("vegan", "Palak Paneer", ["paneer", "spinach"], True),
+    ("vegan", "Stuffed Shells", ["jumbo shells", "ricotta"], True),
+    ("vegan", "Tiramisu", ["mascarpone", "ladyfingers", "espresso"], True),
+    ("vegan", "Potato Salad", ["potatoes", "mayonnaise", "celery"], True),
+    ("gluten-free", "Penne Arrabbiata", ["penne", "tomato", "chili flakes"], True),
+    ("gluten-free", "Vegetable Lasagna", ["lasagna sheets", "zucchini"], True),
+    ("gluten-free", "Margherita Pizza", ["pizza dough", "tomato", "basil"], True),
+    ("gluten-free", "Seitan Stir Fry", ["seitan", "broccoli"], True),
+    ("gluten-free", "Tofu Stir Fry", ["tofu", "soy sauce", "broccoli"], True),
+    ("vegan", "Lentil Curry", ["red lentils", "tomato", "onion", "cumin"], False),
+    ("vegetarian", "Black Bean Tacos", ["black beans", "corn tortillas", "salsa"], False),
+    ("gluten-free", "Tamari Tofu Bowl", ["tofu", "tamari", "rice", "broccoli"], False),
+]
+
+
+@app.command("diet-check")
+def diet_check():
+    """
+    Check the dietary word lists against known meals, exits non-zero on any miss.
+    """
+    failed = 0
+    for tag, name, ingredients, expected in DIET_CASES:
+        hit = diet_violation([tag], name, ingredients)
+        if (hit is not None) != expected:
+            failed += 1
+            print(f"FAIL {tag}: {name} -> {hit or 'allowed'}")
+    print(f"{len(DIET_CASES) - failed}/{len(DIET_CASES)} dietary cases passed")
+    if failed:
+        raise typer.Exit(code=1)
+
+
 if __name__ == "__main__":
     app()